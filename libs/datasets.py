@@ -0,0 +1,61 @@
+import torch
+from PIL import Image
+from torch.utils.data import Dataset
+
+try:
+    from libs.images import load_thumbnail
+except ImportError:
+    # The libs folder itself is on the path in notebooks
+    from images import load_thumbnail
+
+
+class ImageDataset(Dataset):
+    """
+    Image files decoded and preprocessed in DataLoader worker processes.
+
+    Each item is a tuple of the file index and the preprocessed pixel values,
+    or the index and None if the file could not be read.
+    Use collate_images() as collate_fn to build batches.
+    """
+
+    def __init__(self, filepaths, processor, size=None):
+        """
+        Args:
+            filepaths (list of str): Paths to the image files.
+            processor: Hugging Face image processor, e.g. BlipProcessor.image_processor.
+            size (tuple): Downscale the images to fit into this size before preprocessing,
+                see load_thumbnail() in libs/images.py. None uses the full images.
+        """
+        self.filepaths = filepaths
+        self.processor = processor
+        self.size = size
+
+    def __len__(self):
+        return len(self.filepaths)
+
+    def __getitem__(self, index):
+        try:
+            if self.size is not None:
+                img = load_thumbnail(self.filepaths[index], self.size)
+            else:
+                with Image.open(self.filepaths[index]) as img:
+                    img = img.convert("RGB")
+            inputs = self.processor(images=img, return_tensors="pt")
+            return index, inputs["pixel_values"][0]
+        except Exception:
+            return index, None
+
+
+def collate_images(batch):
+    """
+    Stack the pixel values of a batch, skipping unreadable images.
+
+    Returns:
+        tuple: List of file indexes and a tensor of shape (batch, channels, height, width).
+    """
+    batch = [(index, pixels) for index, pixels in batch if pixels is not None]
+    if not batch:
+        return [], None
+
+    indexes, pixels = zip(*batch)
+    return list(indexes), torch.stack(pixels)
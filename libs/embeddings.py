@@ -0,0 +1,251 @@
+import os
+import json
+import tempfile
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+try:
+    from libs.datasets import ImageDataset, collate_images
+    from libs.images import file_hash
+except ImportError:
+    # The libs folder itself is on the path in notebooks
+    from datasets import ImageDataset, collate_images
+    from images import file_hash
+
+
+class EmbeddingStore:
+    """
+    Persistent image embeddings, updated incrementally.
+
+    The features are stored as float32 matrix in embeddings.npy, opened memory-mapped.
+    The file has spare rows and doubles its capacity when full,
+    so adding rows does not copy the whole matrix each time.
+    The index (index.json) maps the ids, e.g. file names, to a row of the matrix
+    and keeps the content hash, modification time and size of each file.
+    Model id and preprocessing version are part of the index, a different model
+    or preprocessing starts a new store.
+
+    Example:
+        store = EmbeddingStore("data/embeddings/vit", "google/vit-base-patch16-224", "thumbnail-100")
+        store.update(filepaths, lambda paths: extract_features(paths, processor, model), ids=filenames)
+        filenames, features = store.get(filenames)
+    """
+
+    def __init__(self, folder, model_id, preprocessing="default"):
+        """
+        Args:
+            folder (str): Folder of the matrix and index files.
+            model_id (str): Model name, e.g. the Hugging Face model id.
+            preprocessing (str): Version of the preprocessing, change it when the input to the model changes.
+        """
+        os.makedirs(folder, exist_ok=True)
+        self.matrix_file = os.path.join(folder, "embeddings.npy")
+        self.index_file = os.path.join(folder, "index.json")
+        self.model_id = model_id
+        self.preprocessing = preprocessing
+        self.files = {}
+        self.rows = 0
+        self.dim = None
+
+        if os.path.isfile(self.index_file):
+            with open(self.index_file, encoding="utf-8") as f:
+                index = json.load(f)
+            if index['model'] == model_id and index['preprocessing'] == preprocessing:
+                self.files = index['files']
+                self.rows = index['rows']
+                self.dim = index['dim']
+            else:
+                print(f"Embedding store {folder} was built with {index['model']} ({index['preprocessing']}), starting over.")
+
+    def __len__(self):
+        return len(self.files)
+
+    def __contains__(self, id):
+        return id in self.files
+
+    @property
+    def matrix(self):
+        """The read-only memory-mapped matrix of all rows, without the spare rows."""
+        if self.rows == 0:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        return np.load(self.matrix_file, mmap_mode="r")[:self.rows]
+
+    def update(self, filepaths, embed, ids=None):
+        """
+        Embed new and changed files.
+
+        Files are compared by modification time and size first, the content hash decides.
+
+        Args:
+            filepaths (list of str): Paths to the image files.
+            embed (function): Get features for a list of file paths, returning a (N, D) array
+                and a bool array of the files that could be read, e.g. extract_features().
+            ids (list of str): Identifiers of the files, defaults to the file paths.
+
+        Returns:
+            int: Number of embedded files.
+        """
+        ids = list(filepaths) if ids is None else list(ids)
+
+        todo = []
+        for id, filepath in zip(ids, filepaths):
+            try:
+                stat = os.stat(filepath)
+            except OSError:
+                continue
+
+            entry = self.files.get(id)
+            if entry is not None and entry['mtime_ns'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+                continue
+
+            digest = file_hash(filepath)
+            if entry is not None and entry['hash'] == digest:
+                entry.update(mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+                continue
+
+            todo.append((id, filepath, {'hash': digest, 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}))
+
+        embedded = 0
+        if todo:
+            features, found = embed([filepath for _, filepath, _ in todo])
+            embedded = int(found.sum())
+            self._write([(id, entry) for (id, _, entry), ok in zip(todo, found) if ok], features[found])
+
+        self._save_index()
+        return embedded
+
+    def get(self, ids=None):
+        """
+        Get the features of ids.
+
+        If the ids are stored in consecutive rows, e.g. all files of a folder
+        embedded in the same order, the features are a view of the memory-mapped matrix, without copy.
+
+        Args:
+            ids (list of str): Identifiers, defaults to all ids in row order.
+
+        Returns:
+            tuple: The ids with features, in the given order, and their (N, D) features.
+        """
+        if ids is None:
+            ids = sorted(self.files, key=lambda id: self.files[id]['row'])
+        ids = [id for id in ids if id in self.files]
+        rows = np.array([self.files[id]['row'] for id in ids], dtype=np.int64)
+
+        matrix = self.matrix
+        if len(rows) and np.array_equal(rows, np.arange(rows[0], rows[0] + len(rows))):
+            return ids, matrix[rows[0]:rows[0] + len(rows)]
+        return ids, matrix[rows]
+
+    def _write(self, entries, features):
+        """Write the features of new and changed ids, growing the matrix file if needed."""
+        if not entries:
+            return
+        if self.dim is not None and self.rows and features.shape[1] != self.dim:
+            raise ValueError(f"Features have {features.shape[1]} dimensions, the store has {self.dim}.")
+        self.dim = features.shape[1]
+
+        # Changed ids keep their row, new ids are appended
+        total = self.rows
+        for id, entry in entries:
+            if id in self.files:
+                entry['row'] = self.files[id]['row']
+            else:
+                entry['row'] = total
+                total += 1
+        rows = [entry['row'] for _, entry in entries]
+
+        capacity = np.load(self.matrix_file, mmap_mode="r").shape[0] if self.rows else 0
+        if total > capacity:
+            # Copy the existing rows into a file with twice the capacity, then swap the files
+            capacity = max(total, 2 * capacity, 1024)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.matrix_file), suffix=".npy")
+            os.close(fd)
+            matrix = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(capacity, self.dim))
+            if self.rows:
+                matrix[:self.rows] = np.load(self.matrix_file, mmap_mode="r")[:self.rows]
+            matrix[rows] = features
+            matrix.flush()
+            del matrix
+            os.replace(tmp_path, self.matrix_file)
+        else:
+            matrix = np.load(self.matrix_file, mmap_mode="r+")
+            matrix[rows] = features
+            matrix.flush()
+            del matrix
+
+        self.rows = total
+        for id, entry in entries:
+            self.files[id] = entry
+
+    def _save_index(self):
+        """Write the index to a temporary file and rename it."""
+        index = {
+            'model': self.model_id, 'preprocessing': self.preprocessing,
+            'dim': self.dim, 'rows': self.rows, 'files': self.files
+        }
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.index_file), suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_file)
+
+
+def extract_features(filepaths, processor, model, batch_size=32, num_workers=4, size=None, device=None,
+                     forward=None):
+    """
+    Extract features of image files, by default the CLS token of a vision transformer, e.g. ViT.
+
+    Images are decoded and preprocessed by DataLoader workers, the model runs on whole batches.
+    Features are copied into a preallocated array batch by batch, so neither the input tensors
+    nor the images are kept.
+
+    Args:
+        filepaths (list of str): Paths to the image files.
+        processor: Hugging Face image processor, e.g. AutoImageProcessor.
+        model: Hugging Face model returning last_hidden_state, e.g. AutoModel.
+        batch_size (int): Number of images per forward pass.
+        num_workers (int): Processes decoding images, 0 decodes in the main process.
+        size (tuple): Downscale the images to fit into this size before preprocessing, see ImageDataset.
+        device (str): Device of the model, defaults to the device of its parameters.
+        forward (function): Get the features from the model and a batch of pixel values,
+            e.g. `lambda model, pixels: model.get_image_features(pixel_values=pixels)` for CLIP.
+            Defaults to the CLS token of the last hidden state.
+
+    Returns:
+        tuple: (N, features) float32 array with the features in the order of the file paths,
+        and a bool array, False for files that could not be read (their rows are zero).
+    """
+    if device is None:
+        device = next(model.parameters()).device
+
+    if forward is None:
+        forward = _cls_features
+
+    # Allocated with the first batch, when the number of features is known
+    features = None
+    found = np.zeros(len(filepaths), dtype=bool)
+
+    dataset = ImageDataset(filepaths, processor, size)
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, collate_fn=collate_images)
+
+    model.eval()
+    with torch.inference_mode():
+        for indexes, pixel_values in loader:
+            if pixel_values is None:
+                continue
+
+            batch = forward(model, pixel_values.to(device)).float().cpu().numpy()
+            if features is None:
+                features = np.zeros((len(filepaths), batch.shape[1]), dtype=np.float32)
+            features[indexes] = batch
+            found[indexes] = True
+
+    if features is None:
+        features = np.zeros((len(filepaths), 0), dtype=np.float32)
+    return features, found
+
+
+def _cls_features(model, pixel_values):
+    """Class token of the last hidden state."""
+    return model(pixel_values=pixel_values).last_hidden_state[:, 0, :]
@@ -1,28 +1,372 @@
 import os
 import base64
+import hashlib
+import html
+import itertools
+import math
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
 from io import BytesIO
-from PIL import Image
+from pathlib import Path
+from PIL import Image, ImageOps
 
-def image_to_data_url(filepath, size=(100, 100)):
+# Encoded thumbnails are stored in this folder, keyed by the image content hash.
+# Set to None or an empty string to disable the disk cache.
+THUMBNAIL_CACHE = os.environ.get("GRAPHIM_THUMBNAIL_CACHE", "data/cache/thumbnails")
 
-    if not os.path.isfile(filepath):
+# Number of encoded thumbnails kept in memory
+MEMORY_CACHE_SIZE = 2048
+
+# Increase when the encoding changes to invalidate cached thumbnails
+CACHE_VERSION = 2
+
+# EXIF tag holding the camera orientation
+ORIENTATION_TAG = 0x0112
+
+# Input tokens per image and per 512 pixel tile in high detail mode of the OpenAI vision models
+IMAGE_BASE_TOKENS = 85
+IMAGE_TILE_TOKENS = 170
+
+# Formats accepted by the image APIs, sent unchanged if the original file fits the budget
+PAYLOAD_MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp", "GIF": "image/gif"}
+
+_memory_cache = OrderedDict()
+_memory_lock = threading.Lock()
+
+
+def image_to_data_url(filepath, size=(100, 100), format="JPEG", fit="stretch", cache_folder=None):
+    """
+    Resize and encode an image file as data URL.
+
+    Args:
+        filepath (str): Path to the image file.
+        size (tuple): Target size, see encode_image() for how the image is fitted.
+        format (str): Image format, e.g. "JPEG" or "PNG".
+        fit (str): "stretch", "contain" or "thumbnail", see encode_image().
+        cache_folder (str): Folder of the disk cache, defaults to THUMBNAIL_CACHE. False disables it.
+
+    Returns:
+        str: The data URL or None if the file could not be read.
+    """
+    encoded = image_to_base64(filepath, size, format, fit, cache_folder)
+    if encoded is None:
+        return None
+    return f"data:image/{format.lower()};base64,{encoded}"
+
+
+def image_to_base64(filepath, size=(100, 100), format="JPEG", fit="stretch", cache_folder=None):
+    """
+    Resize and encode an image file as base64 string.
+
+    Returns:
+        str: The base64 encoded image or None if the file could not be read.
+    """
+    img_bytes = encode_image(filepath, size, format, fit, cache_folder)
+    if img_bytes is None:
+        return None
+    return base64.b64encode(img_bytes).decode("utf-8")
+
+
+def images_to_data_urls(filepaths, size=(100, 100), format="JPEG", fit="stretch", workers=None, chunksize=16,
+                        executor=None):
+    """
+    Encode many image files as data URLs in a process pool.
+
+    On Windows, call it inside an `if __name__ == "__main__":` block when running a script directly.
+
+    Args:
+        filepaths (list of str): Paths to the image files. Empty entries result in None.
+        size, format, fit: See encode_image().
+        workers (int): Number of worker processes, defaults to the number of CPUs.
+            Set to 1 to encode in the current process.
+        chunksize (int): Number of files sent to a worker at once.
+        executor (concurrent.futures.Executor): Reuse an existing pool, e.g. across chunks of a large file.
+
+    Returns:
+        list of str: The data URLs in the order of the file paths, None for files that could not be read.
+    """
+    return _map_files(_data_url_worker, filepaths, size, format, fit, workers, chunksize, executor)
+
+
+def cache_images(filepaths, size=(100, 100), format="JPEG", fit="stretch", workers=None, chunksize=16):
+    """
+    Encode many image files into the disk cache in a process pool.
+
+    Unlike images_to_data_urls(), the encoded images are not returned, so memory stays flat.
+    Later calls of image_to_data_url() with the same arguments read them from the cache.
+
+    Args: See images_to_data_urls().
+
+    Returns:
+        int: Number of images that are available in the cache, 0 if the disk cache is disabled.
+    """
+    # Without the disk cache the encoded images would be thrown away
+    if not THUMBNAIL_CACHE:
+        return 0
+    return sum(_map_files(_cache_worker, filepaths, size, format, fit, workers, chunksize))
+
+
+def encode_image(filepath, size=(100, 100), format="JPEG", fit="stretch", cache_folder=None):
+    """
+    Resize and encode an image file, backed by a content-addressed cache.
+
+    Results are looked up in an in-memory LRU cache, then in the disk cache,
+    both keyed by the hash of the file content, the size, format and fit.
+    Renamed or copied files therefore hit the cache as well.
+
+    Args:
+        filepath (str): Path to the image file.
+        size (tuple): Target width and height.
+        format (str): Image format, e.g. "JPEG" or "PNG".
+        fit (str): How the image is fitted into the size:
+            "stretch" resizes to exactly the size,
+            "contain" scales up or down to fit into the size keeping the aspect ratio,
+            "thumbnail" only scales down keeping the aspect ratio.
+        cache_folder (str): Folder of the disk cache, defaults to THUMBNAIL_CACHE. False disables it.
+
+    Returns:
+        bytes: The encoded image or None if the file could not be read.
+    """
+    key, cache_file = _cache_key(filepath, size, format, fit, cache_folder)
+    if key is None:
+        return None
+
+    with _memory_lock:
+        img_bytes = _memory_cache.get(key)
+        if img_bytes is not None:
+            _memory_cache.move_to_end(key)
+            return img_bytes
+
+    if cache_file and os.path.isfile(cache_file):
+        with open(cache_file, "rb") as f:
+            img_bytes = f.read()
+    else:
+        try:
+            img_bytes = _encode(filepath, size, format, fit)
+        except Exception:
+            return None
+
+        if cache_file:
+            _write_atomic(cache_file, img_bytes)
+
+    with _memory_lock:
+        _memory_cache[key] = img_bytes
+        if len(_memory_cache) > MEMORY_CACHE_SIZE:
+            _memory_cache.popitem(last=False)
+
+    return img_bytes
+
+
+def thumbnail_file(filepath, size=(100, 100), format="JPEG", fit="stretch", cache_folder=None):
+    """
+    Get the path of the cached thumbnail of an image file, encoding it if needed.
+
+    Args: See encode_image(). The disk cache must not be disabled.
+
+    Returns:
+        str: Path of the thumbnail in the disk cache or None if the file could not be read.
+    """
+    key, cache_file = _cache_key(filepath, size, format, fit, cache_folder)
+    if cache_file is None:
+        if key is None:
+            return None
+        raise ValueError("Thumbnail files need a disk cache folder.")
+
+    if not os.path.isfile(cache_file) and encode_image(filepath, size, format, fit, cache_folder) is None:
         return None
+    return cache_file
+
+
+def file_hash(filepath):
+    """
+    Get the SHA-1 hash of a file's content.
+
+    Hashes are cached in memory until the modification time or size of the file changes.
+
+    Returns:
+        str: The hex digest.
+    """
+    stat = os.stat(filepath)
+    return _file_digest(os.path.abspath(filepath), stat.st_mtime_ns, stat.st_size)
+
+
+def image_tokens(width, height):
+    """
+    Estimate the input tokens of an image in high detail mode.
+
+    The API scales the image to fit into 2048x2048, then its shortest side down to 768 pixels,
+    and charges per 512 pixel tile. Models such as gpt-4o-mini charge a fixed multiple of this.
+
+    Returns:
+        int: Estimated number of tokens.
+    """
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return IMAGE_BASE_TOKENS + IMAGE_TILE_TOKENS * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def optimize_payload(filepath, max_bytes=None, max_tokens=None, max_size=2048, formats=("JPEG", "PNG"),
+                     qualities=(85, 70, 55, 40), min_size=128, step=0.75):
+    """
+    Encode an image file for an API upload within a byte and token budget.
 
+    Candidates are tried from the largest to the smallest resolution and, at each resolution,
+    from the highest to the lowest quality. Of the formats, the smallest encoding is used,
+    lossless formats are encoded once per resolution. The first candidate within the budget is returned.
+    The original file competes at the first step, so small files are not recompressed.
+    If no candidate fits, the smallest one is returned.
+
+    Args:
+        filepath (str): Path to the image file.
+        max_bytes (int): Maximum size of the encoded image, None for no limit.
+        max_tokens (int): Maximum image tokens as estimated by image_tokens(), None for no limit.
+        max_size (int): Maximum width and height. The APIs downscale larger images anyway.
+        formats (tuple): Candidate formats, e.g. "JPEG", "WEBP" or "PNG".
+        qualities (tuple): Candidate qualities of lossy formats, highest first.
+        min_size (int): Stop reducing the resolution when the longer side falls below this.
+        step (float): Scale factor between the candidate resolutions.
+
+    Returns:
+        dict: The encoded image ('data'), its 'mime_type', 'format', 'width', 'height', 'quality',
+        'bytes' and 'tokens', the 'original_bytes' of the file and the 'saved_bytes'.
+        None if the file could not be read.
+    """
     try:
-        img = Image.open(filepath)
-        img = img.resize(size, Image.Resampling.LANCZOS)
-        buffered = BytesIO()
-        img.save(buffered, format="JPEG")
-        img_bytes = buffered.getvalue()
-        base64_str = base64.b64encode(img_bytes).decode("utf-8")
-        data_url = f"data:image/jpeg;base64,{base64_str}"
-        return data_url
-    except Exception as e:
+        original_bytes = os.path.getsize(filepath)
+        with Image.open(filepath) as img:
+            original = (img.format, img.size, img.getexif().get(ORIENTATION_TAG, 1))
+        img = load_thumbnail(filepath, (max_size, max_size), fit="thumbnail")
+    except Exception:
         return None
 
-def chromaResults2Html(results, imgfolder, outputfile):
+    def payload(data, format, size, quality):
+        return {
+            'data': data, 'mime_type': PAYLOAD_MIME_TYPES[format], 'format': format,
+            'width': size[0], 'height': size[1], 'quality': quality, 'bytes': len(data),
+            'tokens': image_tokens(*size), 'original_bytes': original_bytes,
+            'saved_bytes': original_bytes - len(data)
+        }
+
+    smallest = None
+    for size in _payload_sizes(img.size, max_tokens, min_size, step):
+        resized = img if size == img.size else img.resize(size, Image.Resampling.LANCZOS)
+
+        for index, quality in enumerate(qualities):
+            candidates = []
+            for format in formats:
+                if format in ("JPEG", "WEBP"):
+                    candidates.append(payload(_save(resized, format, quality), format, size, quality))
+                elif index == 0:
+                    candidates.append(payload(_save(resized, format), format, size, None))
+
+            original_format, original_size, orientation = original
+            if (smallest is None and index == 0 and original_format in PAYLOAD_MIME_TYPES
+                    and max(original_size) <= max_size and orientation == 1
+                    and (max_tokens is None or image_tokens(*original_size) <= max_tokens)):
+                with open(filepath, "rb") as f:
+                    candidates.append(payload(f.read(), original_format, original_size, None))
+
+            best = min(candidates, key=lambda candidate: candidate['bytes'])
+            if max_bytes is None or best['bytes'] <= max_bytes:
+                return best
+            if smallest is None or best['bytes'] < smallest['bytes']:
+                smallest = best
+
+    return smallest
+
+
+def payload_to_data_url(payload):
+    """Encode a payload of optimize_payload() as data URL."""
+    return f"data:{payload['mime_type']};base64,{base64.b64encode(payload['data']).decode('utf-8')}"
+
+
+def load_thumbnail(filepath, size=(100, 100), fit="thumbnail", reducing_gap=2.0):
+    """
+    Load a downscaled RGB version of an image file.
+
+    JPEG files are decoded at a reduced resolution (DCT scaling via draft()),
+    which skips most of the decoding work for large photos.
+    The remaining downscaling uses reducing_gap to shrink by integer factors
+    before the final LANCZOS resampling. EXIF orientation is applied.
+
+    Args:
+        filepath (str): Path to the image file.
+        size (tuple): Target width and height.
+        fit (str): "stretch", "contain" or "thumbnail", see encode_image().
+        reducing_gap (float): Keep at least this factor of the target size for LANCZOS.
+            Higher values are slower but closer to a full resolution resize. None disables it.
+
+    Returns:
+        PIL.Image.Image: The resized image.
+    """
+    with Image.open(filepath) as img:
+        # EXIF rotations by 90 degrees swap width and height
+        draft_width, draft_height = size
+        if img.getexif().get(ORIENTATION_TAG) in (5, 6, 7, 8):
+            draft_width, draft_height = draft_height, draft_width
+
+        gap = reducing_gap or 1.0
+        img.draft("RGB", (int(draft_width * gap), int(draft_height * gap)))
+
+        img = ImageOps.exif_transpose(img)
+        img = img.convert("RGB")
+
+    if fit == "stretch":
+        img = img.resize(size, Image.Resampling.LANCZOS, reducing_gap=reducing_gap)
+    elif fit == "contain":
+        scale = min(size[0] / img.width, size[1] / img.height)
+        img = img.resize((int(img.width * scale), int(img.height * scale)), Image.Resampling.LANCZOS,
+                         reducing_gap=reducing_gap)
+    elif fit == "thumbnail":
+        img.thumbnail(size, Image.Resampling.LANCZOS, reducing_gap=reducing_gap)
+    else:
+        raise ValueError(f"Unknown fit: {fit}")
+
+    return img
+
+
+def chromaResults2Html(results, imgfolder, outputfile, queries=None, size=(600, 600), inline=True, workers=8):
+    """
+    Write the results of a chroma collection query to an HTML page.
+
+    The page is streamed to the file while the thumbnails are generated in a thread pool.
+
+    Args:
+        results (dict): Result of collection.query() with 'ids' and 'distances', one list per query.
+        imgfolder (str): Folder containing the images. The ids are filenames, optionally prefixed with 'file:'.
+        outputfile (str): Path of the HTML file.
+        queries (list of str): Query labels used as headings, defaults to numbering the queries.
+        size (tuple): Thumbnail size.
+        inline (bool): Embed the thumbnails as data URLs. Otherwise, the page
+            links the thumbnail files in the disk cache (see THUMBNAIL_CACHE), which keeps it small.
+        workers (int): Number of threads generating thumbnails.
+
+    Returns:
+        str: The output file path.
+    """
+    outputfolder = os.path.dirname(os.path.abspath(outputfile))
+
+    def thumbnail_src(filename):
+        filepath = os.path.join(imgfolder, filename.replace('file:', ''))
+        if inline:
+            return image_to_data_url(filepath, size) or ""
+
+        thumbfile = thumbnail_file(filepath, size)
+        if thumbfile is None:
+            return ""
+        try:
+            return os.path.relpath(os.path.abspath(thumbfile), outputfolder).replace(os.sep, "/")
+        except ValueError:
+            # Different drives on Windows
+            return Path(os.path.abspath(thumbfile)).as_uri()
 
-    html_content = """
+    with open(outputfile, "w", encoding="utf-8") as f, ThreadPoolExecutor(max_workers=workers) as executor:
+        f.write("""
     <!DOCTYPE html>
     <html lang="en">
     <head>
@@ -42,27 +386,128 @@ def chromaResults2Html(results, imgfolder, outputfile):
         </style>
     </head>
     <body>
+    """)
+
+        for query_no, (ids, distances) in enumerate(zip(results['ids'], results['distances'])):
+            label = queries[query_no] if queries else f"Query {query_no + 1}"
+            f.write(f"""
+    <h2>{html.escape(str(label))}</h2>
     <div class="resultlist">
-    """
+    """)
 
-    for filename, dist in zip(results['ids'][0], results['distances'][0]):
-        filepath = os.path.join(imgfolder, filename.replace('file:', ''))
-        filedata = image_to_data_url(filepath, (600, 600))
-        html_content += f"""
+            for filename, dist, src in zip(ids, distances, executor.map(thumbnail_src, ids)):
+                filename = html.escape(filename)
+                f.write(f"""
         <div class="result">
-            <img src="{filedata}" alt="{filename}" />
+            <img src="{html.escape(src)}" alt="{filename}" />
             <div class="result-title">{filename}</div>
             <div class="result-distance">Distance: {dist:.4f}</div>
         </div>
-        """
+        """)
 
-    html_content += """
+            f.write("""
     </div>
+    """)
+
+        f.write("""
     </body>
     </html>
-    """
+    """)
+
+    return outputfile
+
+
+def _data_url_worker(filepath, size, format, fit):
+    """Encode one image file, used as process pool worker."""
+    if not isinstance(filepath, str) or not filepath:
+        return None
+    return image_to_data_url(filepath, size, format, fit)
+
+
+def _cache_worker(filepath, size, format, fit):
+    """Encode one image file into the cache, used as process pool worker."""
+    if not isinstance(filepath, str) or not filepath:
+        return False
+    return encode_image(filepath, size, format, fit) is not None
+
+
+def _map_files(worker, filepaths, size, format, fit, workers=None, chunksize=16, executor=None):
+    """Map a worker over image files, in a process pool unless workers is 1."""
+    args = (filepaths, itertools.repeat(size), itertools.repeat(format), itertools.repeat(fit))
+
+    if executor is not None:
+        return list(executor.map(worker, *args, chunksize=chunksize))
+    if workers == 1:
+        return list(map(worker, *args))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(worker, *args, chunksize=chunksize))
+
+
+def _encode(filepath, size, format, fit):
+    """Load, resize and encode an image file."""
+    img = load_thumbnail(filepath, size, fit)
+    buffered = BytesIO()
+    img.save(buffered, format=format)
+    return buffered.getvalue()
+
+
+def _save(img, format, quality=None):
+    """Encode an image in memory."""
+    buffered = BytesIO()
+    if quality is None:
+        img.save(buffered, format=format, optimize=True)
+    else:
+        img.save(buffered, format=format, quality=quality)
+    return buffered.getvalue()
+
+
+def _payload_sizes(size, max_tokens, min_size, step):
+    """Candidate sizes for optimize_payload(), largest first. The smallest is always included."""
+    width, height = size
+    scale = 1.0
+    while True:
+        candidate = (max(1, round(width * scale)), max(1, round(height * scale)))
+        last = max(candidate) * step < min_size
+        if last or max_tokens is None or image_tokens(*candidate) <= max_tokens:
+            yield candidate
+        if last:
+            return
+        scale *= step
+
+
+def _cache_key(filepath, size, format, fit, cache_folder):
+    """Get the content-addressed cache key and disk cache file of a thumbnail."""
+    if not os.path.isfile(filepath):
+        return None, None
+
+    try:
+        digest = file_hash(filepath)
+    except OSError:
+        return None, None
+
+    if cache_folder is None:
+        cache_folder = THUMBNAIL_CACHE
+
+    width, height = size
+    key = f"{digest}_{width}x{height}_{fit}_v{CACHE_VERSION}.{format.lower()}"
+    cache_file = os.path.join(cache_folder, key[:2], key) if cache_folder else None
+    return key, cache_file
+
+
+@lru_cache(maxsize=65536)
+def _file_digest(filepath, mtime_ns, filesize):
+    """Hash the file content. Modification time and size invalidate the cached hash."""
+    sha1 = hashlib.sha1()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
 
-    with open(outputfile, "w", encoding="utf-8") as f:
-        f.write(html_content)
 
-    return outputfile
\ No newline at end of file
+def _write_atomic(filepath, data):
+    """Write to a temporary file and rename it, so that parallel writers never see partial files."""
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filepath), suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, filepath)
@@ -0,0 +1,234 @@
+import os
+import json
+import time
+import random
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from openai import AsyncOpenAI, APIStatusError, APIConnectionError
+
+try:
+    from libs.images import file_hash, optimize_payload, payload_to_data_url
+except ImportError:
+    # The libs folder itself is on the path in notebooks
+    from images import file_hash, optimize_payload, payload_to_data_url
+
+
+class RateLimiter:
+    """
+    Token bucket for request or token limits per minute.
+
+    The bucket holds up to one minute of budget and refills continuously.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.available = per_minute
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount=1):
+        """Wait until the amount is available and take it."""
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            self._refill()
+            while self.available < amount:
+                await asyncio.sleep((amount - self.available) / self.rate)
+                self._refill()
+            self.available -= amount
+
+    def consume(self, amount):
+        """Take an amount without waiting, e.g. tokens used beyond the estimate."""
+        self._refill()
+        self.available -= amount
+
+
+def prompt_images(image_files, prompt, output_file, **kwargs):
+    """
+    Send an image prompt for each image file, see prompt_images_async().
+
+    In notebooks and interactive windows, where an event loop is already running,
+    the requests run on a new event loop in a worker thread and the call blocks until they are done.
+    Use `await prompt_images_async(...)` there to keep the notebook responsive.
+    """
+    coroutine = prompt_images_async(image_files, prompt, output_file, **kwargs)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+async def prompt_images_async(image_files, prompt, output_file, model="gpt-4o-mini", ids=None,
+                              api_key=None, base_url=None, client=None,
+                              concurrency=8, requests_per_minute=500, tokens_per_minute=200000,
+                              tokens_per_request=1000, max_retries=5, backoff=1.0, max_backoff=60.0,
+                              max_bytes=None, max_tokens=None, cache=None):
+    """
+    Send an image prompt for each image file to the Responses API, concurrently.
+
+    Requests are limited by the concurrency and by request and token budgets per minute.
+    Rate limit (429) and server errors (5xx) are retried with exponential backoff,
+    honouring the Retry-After header. Each result is appended to a JSON lines file
+    as soon as it arrives. Images with a result in the file are skipped,
+    so an interrupted run continues where it stopped. Failed images are retried on the next run.
+
+    Args:
+        image_files (list of str): Paths to the image files.
+        prompt (str): The prompt sent with each image.
+        output_file (str): JSON lines file for the results.
+        model (str): Model name.
+        ids (list of str): Identifiers of the images in the output, defaults to the file paths.
+        api_key (str): OpenAI API key.
+        base_url (str): API base URL, e.g. of a local stub server (see scripts/extract/llm_stub.py).
+        client (AsyncOpenAI): Preconfigured client, replaces api_key and base_url.
+        concurrency (int): Maximum number of requests in flight.
+        requests_per_minute (int): Request budget.
+        tokens_per_minute (int): Token budget.
+        tokens_per_request (int): Estimated tokens per request, reserved before sending.
+            Tokens used beyond the estimate are charged when the response arrives.
+        max_retries (int): Retries per image.
+        backoff (float): Initial retry delay in seconds, doubled with each retry.
+        max_backoff (float): Maximum retry delay in seconds.
+        max_bytes (int): Upload budget per image. Images are downscaled and recompressed
+            to fit, see optimize_payload() in libs/images.py.
+        max_tokens (int): Image token budget per image, see image_tokens() in libs/images.py.
+        cache (ResponseCache): Look up responses by image content, prompt and model
+            before sending a request, and store new responses (see libs/responsecache.py).
+
+    Returns:
+        dict: Number of images completed by a request, answered from the cache,
+        skipped because of an existing result and failed,
+        and the total bytes uploaded and saved by optimizing the images.
+    """
+    if ids is None:
+        ids = list(image_files)
+    if client is None:
+        client = AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0)
+
+    completed = _completed_ids(output_file)
+    todo = [(image_id, filepath) for image_id, filepath in zip(ids, image_files) if image_id not in completed]
+
+    semaphore = asyncio.Semaphore(concurrency)
+    request_limiter = RateLimiter(requests_per_minute)
+    token_limiter = RateLimiter(tokens_per_minute)
+    counts = {'completed': 0, 'cached': 0, 'skipped': len(ids) - len(todo), 'failed': 0,
+              'uploaded_bytes': 0, 'saved_bytes': 0}
+
+    # Answers depend on the image as sent, so the budgets are part of the cache key
+    params = {'max_bytes': max_bytes, 'max_tokens': max_tokens}
+
+    async def process(image_id, filepath, out):
+        async with semaphore:
+            record = {'id': image_id, 'file': filepath, 'model': model}
+            try:
+                image_hash = file_hash(filepath) if cache is not None else None
+                cached = cache.get(image_hash, prompt, model, params) if cache is not None else None
+                if cached is not None:
+                    record.update(cached)
+                    record['cached'] = True
+                    counts['cached'] += 1
+                else:
+                    # Encode in a thread, so that the other requests keep going
+                    payload = await asyncio.to_thread(optimize_payload, filepath,
+                                                      max_bytes=max_bytes, max_tokens=max_tokens)
+                    if payload is None:
+                        raise ValueError(f"Could not read image {filepath}")
+                    record['upload'] = {key: payload[key] for key in
+                                        ('format', 'width', 'height', 'bytes', 'saved_bytes')}
+                    counts['uploaded_bytes'] += payload['bytes']
+                    counts['saved_bytes'] += payload['saved_bytes']
+
+                    response = await _create_with_retry(
+                        client, model, prompt, payload_to_data_url(payload), request_limiter, token_limiter,
+                        tokens_per_request, max_retries, backoff, max_backoff
+                    )
+                    result = {'text': response.output_text}
+                    if response.usage is not None:
+                        result['usage'] = {
+                            'input_tokens': response.usage.input_tokens,
+                            'output_tokens': response.usage.output_tokens
+                        }
+                    if cache is not None:
+                        cache.put(image_hash, prompt, model, result, params)
+
+                    record.update(result)
+                    counts['completed'] += 1
+            except Exception as e:
+                record['error'] = str(e)
+                counts['failed'] += 1
+
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+
+    with open(output_file, "a", encoding="utf-8") as out:
+        await asyncio.gather(*(process(image_id, filepath, out) for image_id, filepath in todo))
+
+    return counts
+
+
+async def _create_with_retry(client, model, prompt, image_url, request_limiter, token_limiter,
+                             tokens_per_request, max_retries, backoff, max_backoff):
+    """Send one request, retrying on rate limits, server and connection errors."""
+    content = [
+        {"type": "input_text", "text": prompt},
+        {"type": "input_image", "image_url": image_url},
+    ]
+
+    for attempt in range(max_retries + 1):
+        await request_limiter.acquire()
+        await token_limiter.acquire(tokens_per_request)
+
+        try:
+            response = await client.responses.create(model=model, input=[{"role": "user", "content": content}])
+        except APIStatusError as e:
+            if (e.status_code != 429 and e.status_code < 500) or attempt == max_retries:
+                raise
+            delay = _retry_after(e.response)
+        except APIConnectionError:
+            if attempt == max_retries:
+                raise
+            delay = None
+        else:
+            if response.usage is not None:
+                token_limiter.consume(max(0, response.usage.total_tokens - tokens_per_request))
+            return response
+
+        if delay is None:
+            delay = min(max_backoff, backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+        await asyncio.sleep(delay)
+
+
+def _retry_after(response):
+    """Get the delay in seconds from a Retry-After header."""
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _completed_ids(output_file):
+    """Collect the ids of successful results in a JSON lines file."""
+    completed = set()
+    if not os.path.isfile(output_file):
+        return completed
+
+    with open(output_file, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Partially written line of an interrupted run
+                continue
+            if 'error' not in record:
+                completed.add(record['id'])
+
+    return completed
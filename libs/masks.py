@@ -0,0 +1,515 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import cv2
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+try:
+    from libs.images import file_hash
+except ImportError:
+    # The libs folder itself is on the path in notebooks
+    from images import file_hash
+
+# Raw model masks are stored in this folder, keyed by the image content hash and the model parameters
+MASK_CACHE = os.environ.get("GRAPHIM_MASK_CACHE", "data/cache/masks")
+
+# Number of set bits of each byte value
+_POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+
+class PackedMasks:
+    """
+    Binary masks of one image, packed to one bit per pixel.
+
+    The rows of each mask are packed with np.packbits, so a mask takes H * ceil(W / 8) bytes
+    instead of H * W bytes as uint8 or 4 * H * W bytes as float mask.
+    Bounding boxes and areas are computed once when packing.
+
+    Indexing with an integer returns a PackedMask, slices and index arrays return PackedMasks.
+    """
+
+    def __init__(self, bits, shape, boxes=None, areas=None):
+        """
+        Args:
+            bits (np.ndarray): (N, H, ceil(W / 8)) packed masks.
+            shape (tuple): Height and width of the masks.
+            boxes (np.ndarray): (N, 4) bounding boxes as (x_min, y_min, x_max, y_max), computed if None.
+            areas (np.ndarray): (N,) number of mask pixels, computed if None.
+        """
+        self.bits = bits
+        self.shape = tuple(shape)
+        self.boxes = _packed_bboxes(bits, self.shape[1]) if boxes is None else boxes
+        self.areas = _POPCOUNT[bits].sum(axis=(1, 2), dtype=np.int64) if areas is None else areas
+
+    @classmethod
+    def from_dense(cls, masks, threshold=0.5, chunk_size=32):
+        """
+        Pack masks, e.g. the float masks of a segmentation model.
+
+        Args:
+            masks: (N, H, W) NumPy array, torch tensor or list of (H, W) arrays.
+                Tensors are thresholded on their device and copied in chunks,
+                so the float masks are never copied to host memory as a whole.
+            threshold (float): Pixels above the threshold belong to the mask.
+            chunk_size (int): Number of masks thresholded and packed at once.
+
+        Returns:
+            PackedMasks: The packed masks.
+        """
+        shape = tuple(masks.shape[1:]) if hasattr(masks, "shape") else masks[0].shape
+        chunks = [np.zeros((0, shape[0], (shape[1] + 7) // 8), dtype=np.uint8)]
+        for start in range(0, len(masks), chunk_size):
+            chunk = masks[start:start + chunk_size]
+            if isinstance(chunk, list):
+                chunk = np.stack(chunk, axis=0)
+            chunk = chunk > threshold
+            if hasattr(chunk, "cpu"):
+                chunk = chunk.cpu().numpy()
+            chunks.append(np.packbits(chunk, axis=2))
+
+        return cls(np.concatenate(chunks, axis=0), shape)
+
+    def __len__(self):
+        return self.bits.shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return PackedMask(self.bits[index], self.shape, self.boxes[index], self.areas[index])
+        return PackedMasks(self.bits[index], self.shape, self.boxes[index], self.areas[index])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def to_dense(self):
+        """Unpack to a (N, H, W) uint8 array of zeros and ones."""
+        return np.unpackbits(self.bits, axis=2, count=self.shape[1])
+
+    def merge(self, labels):
+        """
+        Combine masks by a label per mask, e.g. connected components.
+
+        Returns:
+            PackedMasks: The union of all masks with label k at index k.
+        """
+        count = labels.max() + 1 if len(labels) else 0
+        bits = np.zeros((count,) + self.bits.shape[1:], dtype=np.uint8)
+        for index, label in enumerate(labels):
+            bits[label] |= self.bits[index]
+        return PackedMasks(bits, self.shape)
+
+    def intersection(self, i, j):
+        """Number of pixels in both mask i and mask j."""
+        x_min, y_min = np.maximum(self.boxes[i, :2], self.boxes[j, :2])
+        x_max, y_max = np.minimum(self.boxes[i, 2:], self.boxes[j, 2:])
+        if x_min >= x_max or y_min >= y_max:
+            return 0
+
+        # Outside the overlap of the boxes, one of the masks is empty,
+        # so the window may be widened to whole bytes
+        window = (slice(y_min, y_max), slice(x_min // 8, (x_max + 7) // 8))
+        return int(_POPCOUNT[self.bits[i][window] & self.bits[j][window]].sum())
+
+
+class MaskCache:
+    """
+    Disk cache of the raw masks of a segmentation model, e.g. FastSAM.
+
+    The packed masks of each image are stored as compressed npz file,
+    keyed by the hash of the image content and the model parameters.
+    A manifest (manifest.jsonl in the folder) lists the image, parameters
+    and number of masks of each entry. With cached masks, merging and cropping
+    can be re-tuned without running the model again.
+    """
+
+    def __init__(self, folder=MASK_CACHE):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.manifest_file = os.path.join(folder, "manifest.jsonl")
+
+    @staticmethod
+    def key(image_hash, params):
+        """Combine the image hash and the model parameters to a cache key."""
+        data = json.dumps([image_hash, params], sort_keys=True)
+        return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+    def path(self, image_path, params):
+        """Get the npz file of an image, whether it exists or not."""
+        key = self.key(file_hash(image_path), params)
+        return os.path.join(self.folder, key[:2], key + ".npz")
+
+    def get(self, image_path, params):
+        """
+        Load the cached masks of an image.
+
+        Returns:
+            PackedMasks: The masks or None if there is no entry.
+        """
+        path = self.path(image_path, params)
+        if not os.path.isfile(path):
+            return None
+        return load_masks(path)
+
+    def put(self, image_path, params, masks):
+        """Store the masks of an image and add them to the manifest."""
+        image_hash = file_hash(image_path)
+        key = self.key(image_hash, params)
+        path = os.path.join(self.folder, key[:2], key + ".npz")
+        save_masks(masks, path)
+
+        entry = {
+            'key': key, 'image': image_path, 'image_hash': image_hash, 'params': params,
+            'masks': len(masks), 'bytes': os.path.getsize(path), 'created': time.time()
+        }
+        with open(self.manifest_file, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def manifest(self):
+        """
+        Read the manifest, the latest entry per key.
+
+        Returns:
+            list of dict: Key, image path and hash, parameters, number of masks, file size and creation time.
+        """
+        entries = {}
+        if os.path.isfile(self.manifest_file):
+            with open(self.manifest_file, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Partially written line of an interrupted run
+                        continue
+                    entries[entry['key']] = entry
+        return list(entries.values())
+
+
+class PackedMask:
+    """A single mask of PackedMasks."""
+
+    def __init__(self, bits, shape, box, area):
+        self.bits = bits
+        self.shape = tuple(shape)
+        self.box = tuple(int(value) for value in box)
+        self.area = int(area)
+
+    def to_dense(self):
+        """Unpack to a (H, W) uint8 array of zeros and ones."""
+        return np.unpackbits(self.bits, axis=1, count=self.shape[1])
+
+    def crop(self, box=None):
+        """
+        Unpack only a window of the mask.
+
+        Args:
+            box (tuple): (x_min, y_min, x_max, y_max), defaults to the bounding box of the mask.
+
+        Returns:
+            np.ndarray: (y_max - y_min, x_max - x_min) uint8 array of zeros and ones.
+        """
+        x_min, y_min, x_max, y_max = self.box if box is None else box
+        byte_min = x_min // 8
+        window = self.bits[y_min:y_max, byte_min:(x_max + 7) // 8]
+        return np.unpackbits(window, axis=1)[:, x_min - byte_min * 8:x_max - byte_min * 8]
+
+
+def save_masks(masks, path):
+    """Save packed masks to a compressed npz file, written atomically."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        np.savez_compressed(f, bits=masks.bits, shape=np.array(masks.shape), boxes=masks.boxes, areas=masks.areas)
+    os.replace(tmp_path, path)
+
+
+def load_masks(path):
+    """Load packed masks saved by save_masks()."""
+    with np.load(path) as data:
+        return PackedMasks(data['bits'], tuple(int(value) for value in data['shape']), data['boxes'], data['areas'])
+
+
+def box_contains_ratios(boxes, min_ratio=0.8):
+    """
+    Check area overlap ratio of all pairs of bounding boxes as rough filter.
+    :param boxes: (N, 4) boxes as (x_min, y_min, x_max, y_max)
+    :return: (N, N) bool array, True where box i lies at least min_ratio inside box j
+    """
+    x_min, y_min, x_max, y_max = (boxes[:, k].astype(np.int64) for k in range(4))
+
+    width = np.minimum(x_max[:, None], x_max[None, :]) - np.maximum(x_min[:, None], x_min[None, :])
+    height = np.minimum(y_max[:, None], y_max[None, :]) - np.maximum(y_min[:, None], y_min[None, :])
+    overlapping = (width > 0) & (height > 0)
+
+    inter_area = np.where(overlapping, width * height, 0)
+    small_area = ((x_max - x_min) * (y_max - y_min))[:, None]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return overlapping & (inter_area / small_area >= min_ratio)
+
+
+def block_counts(masks, max_blocks=16384):
+    """
+    Downsample packed masks to pixel counts per square block.
+    :param masks: PackedMasks
+    :param max_blocks: the block size grows with the image, starting at 8 pixels, to stay below this number of blocks
+    :return: (N, blocks) counts, the block size and (N,) pixels in the margin outside the block grid
+    """
+    N, H, byte_width = masks.bits.shape
+    block = 8 * max(1, int(np.ceil(np.sqrt(H * masks.shape[1] / max_blocks) / 8)))
+    rows, cols = H // block, byte_width // (block // 8)
+
+    # Count the bits per byte, sum the rows of each block, then the bytes
+    grid = _POPCOUNT[masks.bits[:, :rows * block, :cols * (block // 8)]]
+    counts = grid.reshape(N, rows, block, cols * (block // 8)).sum(axis=2, dtype=np.uint16)
+    counts = counts.reshape(N, rows, cols, block // 8).sum(axis=3, dtype=np.uint32).reshape(N, rows * cols)
+
+    margin = masks.areas - counts.sum(axis=1, dtype=np.int64)
+    return counts, block, margin
+
+
+def mergeMasks(masks, threshold = 0.9):
+    """
+    Merge masks that are mostly contained in each other.
+
+    Masks i and j are connected if at least threshold of the pixels of i are in j.
+    Each connected group of masks is merged into one mask.
+    :param masks: PackedMasks, or (N, H, W) array or list of masks, binarized at 0.5
+    :return: PackedMasks, one per group
+    """
+    if not isinstance(masks, PackedMasks):
+        masks = PackedMasks.from_dense(masks)
+
+    # Quick bbox filter: is bbox i mostly inside bbox j?
+    candidates = box_contains_ratios(masks.boxes, min_ratio=0.8)
+    np.fill_diagonal(candidates, False)
+
+    # Bound all pairwise intersections at once by matrix products of the downsampled masks:
+    # pixels of i in blocks fully covered by j are a lower bound,
+    # pixels of i in blocks touched by j or outside the block grid an upper bound
+    counts, block, margin = block_counts(masks)
+    areas = masks.areas
+    counts = counts.astype(np.float64)
+    lower = counts @ (counts == block * block).T
+    upper = counts @ (counts > 0).T + margin[:, None]
+
+    # Build adjacency matrix for "mostly contained" relation
+    candidates &= (areas > 0)[:, None]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        adjacency = candidates & (lower / areas[:, None] >= threshold)
+        undecided = candidates & ~adjacency & (upper / areas[:, None] >= threshold)
+
+    # Compute the exact pixel overlap of the remaining pairs
+    for i, j in zip(*np.nonzero(undecided)):
+        adjacency[i, j] = masks.intersection(i, j) / areas[i] >= threshold
+
+    # Symmetrize adjacency for undirected connected groups
+    undirected_adj = adjacency | adjacency.T
+
+    # Find connected components and merge masks in each group
+    n_components, labels = connected_components(csgraph=undirected_adj, directed=False, return_labels=True)
+    return masks.merge(labels)
+
+
+def tile_boxes(height, width, tile_size=1024, overlap=128):
+    """
+    Split an image into overlapping tiles for tiled segmentation.
+
+    Tile offsets are multiples of 8 pixels, so the packed masks of the tiles align
+    with the bytes of the packed image masks. Tiles at the right and bottom edges are smaller.
+    :param tile_size: width and height of the tiles, rounded down to a multiple of 8
+    :param overlap: overlap of neighbouring tiles in pixels, should exceed the size of small components
+    :return: list of tile boxes (x_min, y_min, x_max, y_max)
+    """
+    tile_size = max(8, tile_size // 8 * 8)
+    if overlap >= tile_size:
+        raise ValueError(f"The overlap must be smaller than the tile size of {tile_size}")
+    stride = max(8, (tile_size - overlap) // 8 * 8)
+
+    def starts(length):
+        return list(range(0, max(1, length - overlap), stride)) if length > tile_size else [0]
+
+    return [(x, y, min(x + tile_size, width), min(y + tile_size, height))
+            for y in starts(height) for x in starts(width)]
+
+
+def stitch_masks(tiles, shape, min_iou=0.5):
+    """
+    Combine the masks of overlapping tiles into masks of the whole image.
+
+    Masks of neighbouring tiles are the same component if their intersection over union
+    within the overlap of the tiles reaches min_iou. This joins components cut by a tile border
+    and removes components found twice in the overlap.
+    :param tiles: list of (tile box, PackedMasks of the tile) with boxes from tile_boxes()
+    :param shape: height and width of the image
+    :param min_iou: threshold of the intersection over union in the overlap
+    :return: PackedMasks of the image
+    """
+    offsets = np.cumsum([0] + [len(masks) for _, masks in tiles])
+    rows, cols = [], []
+
+    for a, (box_a, masks_a) in enumerate(tiles):
+        for b in range(a + 1, len(tiles)):
+            box_b, masks_b = tiles[b]
+            x_min, y_min = max(box_a[0], box_b[0]), max(box_a[1], box_b[1])
+            x_max, y_max = min(box_a[2], box_b[2]), min(box_a[3], box_b[3])
+            if x_min >= x_max or y_min >= y_max:
+                continue
+
+            # Masks of both tiles within the overlap, flattened to packed bytes
+            window_a = _tile_window(masks_a, box_a, (x_min, y_min, x_max, y_max))
+            window_b = _tile_window(masks_b, box_b, (x_min, y_min, x_max, y_max))
+            filled_a = np.nonzero(window_a.any(axis=1))[0]
+            filled_b = np.nonzero(window_b.any(axis=1))[0]
+            if len(filled_a) == 0 or len(filled_b) == 0:
+                continue
+
+            # Intersections of all pairs as product of the unpacked windows
+            pixels_a = np.unpackbits(window_a[filled_a], axis=1).astype(np.float32)
+            pixels_b = np.unpackbits(window_b[filled_b], axis=1).astype(np.float32)
+            intersections = pixels_a @ pixels_b.T
+            unions = pixels_a.sum(axis=1)[:, None] + pixels_b.sum(axis=1)[None, :] - intersections
+            matches_a, matches_b = np.nonzero(intersections >= min_iou * unions)
+
+            rows.extend(offsets[a] + filled_a[matches_a])
+            cols.extend(offsets[b] + filled_b[matches_b])
+
+    # Group the matched masks of all tiles and paint each group into the image
+    count = offsets[-1]
+    adjacency = coo_matrix((np.ones(len(rows), dtype=bool), (rows, cols)), shape=(count, count))
+    n_components, labels = connected_components(csgraph=adjacency, directed=False, return_labels=True)
+
+    height, width = shape
+    bits = np.zeros((n_components, height, (width + 7) // 8), dtype=np.uint8)
+    for tile, ((x_min, y_min, x_max, y_max), masks) in enumerate(tiles):
+        byte_min = x_min // 8
+        for index, label in enumerate(labels[offsets[tile]:offsets[tile + 1]]):
+            bits[label, y_min:y_max, byte_min:byte_min + masks.bits.shape[2]] |= masks.bits[index]
+    return PackedMasks(bits, shape)
+
+
+def createTransparentSegment(image_rgb, mask, blur_kernel_size=0, blur_sigma=0):
+    """
+    Create RGBA image with smooth alpha channel from mask.
+    :param image_rgb: (H, W, 3) RGB uint8 image
+    :param mask: PackedMask or (H, W) binary mask uint8 (0 or 255)
+    :param blur_kernel_size: kernel size for Gaussian blur (odd, e.g., 15)
+    :param blur_sigma: Gaussian blur sigma; 0 = auto
+    :return: (H, W, 4) RGBA image with fuzzy alpha
+   """
+    if isinstance(mask, PackedMask):
+        mask = mask.to_dense()
+    mask = (mask > 0).astype(np.uint8) * 255
+
+    # Convert RGB to BGRA
+    bgra = cv2.cvtColor(image_rgb, cv2.COLOR_RGB2BGRA)
+
+    # Blur mask for fuzzy edges
+    if blur_kernel_size > 0:
+        mask = cv2.GaussianBlur(mask, (blur_kernel_size, blur_kernel_size), blur_sigma)
+        mask = np.clip(mask, 0, 255).astype(np.uint8)
+
+    # Set alpha channel from mask
+    bgra[:, :, 3] = mask
+
+    rgba = cv2.cvtColor(bgra, cv2.COLOR_BGRA2RGBA)
+    return rgba
+
+
+def cropTransparentSegment(image_rgba, box=None):
+    """
+    Crop transparent RGBA image to bounding box of non-transparent pixels.
+    :param image_rgba: (H, W, 4) RGBA image with alpha channel
+    :param box: known bounding box (x_min, y_min, x_max, y_max), e.g. PackedMask.box of an unblurred mask,
+        skips searching the alpha channel
+    :return: cropped RGBA image
+    """
+    if box is not None and box[2] > box[0] and box[3] > box[1]:
+        x_min, y_min, x_max, y_max = box
+        return image_rgba[y_min:y_max, x_min:x_max].copy()
+
+    bgra = cv2.cvtColor(image_rgba, cv2.COLOR_RGB2BGRA)
+    alpha = bgra[:, :, 3]
+
+    coords = cv2.findNonZero(alpha)
+    if coords is None:
+        # No non-transparent pixels – return empty image or original
+        return bgra
+
+    x, y, w, h = cv2.boundingRect(coords)
+    cropped = bgra[y:y+h, x:x+w]
+    cropped = cv2.cvtColor(cropped, cv2.COLOR_BGRA2RGBA)
+    return cropped
+
+
+def extractSegment(image_bgr, mask, blur_kernel_size=0, blur_sigma=0):
+    """
+    Cut out a mask as BGRA image, cropped to the mask, ready for cv2.imwrite.
+
+    Same result as createTransparentSegment() followed by cropTransparentSegment(),
+    but the image and mask are cropped to the bounding box first,
+    so the colour conversion and blur only touch the pixels of the segment.
+    :param image_bgr: (H, W, 3) BGR uint8 image as read by cv2.imread
+    :param mask: PackedMask
+    :param blur_kernel_size: kernel size for Gaussian blur (odd, e.g., 15)
+    :param blur_sigma: Gaussian blur sigma; 0 = auto
+    :return: (h, w, 4) BGRA image
+    """
+    if mask.area == 0:
+        # No non-transparent pixels, like cropTransparentSegment()
+        return cv2.cvtColor(image_bgr, cv2.COLOR_BGR2BGRA) * np.array([1, 1, 1, 0], dtype=np.uint8)
+
+    # Widen the box, the blurred alpha reaches up to the kernel radius beyond the mask.
+    # With a margin of twice the radius, the reflected border of the window is empty like the image around it.
+    x_min, y_min, x_max, y_max = mask.box
+    if blur_kernel_size > 0:
+        radius = 2 * (blur_kernel_size // 2)
+        height, width = mask.shape
+        x_min, y_min = max(0, x_min - radius), max(0, y_min - radius)
+        x_max, y_max = min(width, x_max + radius), min(height, y_max + radius)
+
+    alpha = mask.crop((x_min, y_min, x_max, y_max)) * np.uint8(255)
+    if blur_kernel_size > 0:
+        alpha = cv2.GaussianBlur(alpha, (blur_kernel_size, blur_kernel_size), blur_sigma)
+
+    bgra = cv2.cvtColor(image_bgr[y_min:y_max, x_min:x_max], cv2.COLOR_BGR2BGRA)
+    bgra[:, :, 3] = alpha
+
+    if blur_kernel_size > 0:
+        x, y, w, h = cv2.boundingRect(cv2.findNonZero(alpha))
+        bgra = bgra[y:y + h, x:x + w]
+    return bgra
+
+
+def _tile_window(masks, tile_box, window):
+    """Packed bytes of the masks of a tile within a window of the image, flattened per mask."""
+    x_min, y_min, x_max, y_max = window
+    rows = slice(y_min - tile_box[1], y_max - tile_box[1])
+    columns = slice((x_min - tile_box[0]) // 8, (x_max - tile_box[0] + 7) // 8)
+    return masks.bits[:, rows, columns].reshape(len(masks), -1)
+
+
+def _packed_bboxes(bits, width):
+    """Bounding boxes of packed masks as (N, 4) array of (x_min, y_min, x_max, y_max), zeros for empty masks."""
+    rows = bits.any(axis=2)
+    cols = np.unpackbits(np.bitwise_or.reduce(bits, axis=1), axis=1, count=width).astype(bool)
+    return _bboxes(rows, cols)
+
+
+def _bboxes(rows, cols):
+    """Bounding boxes from the (N, H) occupied rows and (N, W) occupied columns of masks."""
+    filled = rows.any(axis=1)
+    boxes = np.stack([
+        cols.argmax(axis=1),
+        rows.argmax(axis=1),
+        cols.shape[1] - cols[:, ::-1].argmax(axis=1),
+        rows.shape[1] - rows[:, ::-1].argmax(axis=1)
+    ], axis=1)
+    boxes[~filled] = 0
+    return boxes
@@ -1,53 +1,336 @@
 import base64
+import gzip
+import itertools
+from datetime import date
 from io import BytesIO
+import numpy as np
 import pandas as pd
-import networkx as nx
+from lxml import etree
+from scipy.sparse import coo_matrix, csr_matrix
+from scipy.sparse.csgraph import connected_components
 
+try:
+    from libs.images import images_to_data_urls
+except ImportError:
+    # The libs folder itself is on the path in notebooks
+    from images import images_to_data_urls
 
-def get_edges(dist_matrix, threshold, nodeslist):
+GEXF_NS = "http://www.gexf.net/1.2draft"
+
+
+def get_edge_arrays(dist_matrix, threshold, block_size=1024):
     """
-    Construct an edge list from a distance matrix based on a threshold.
+    Threshold the upper triangle of a distance matrix in row blocks.
+
+    Only block_size rows are compared at once, so the temporary masks
+    stay bounded at block_size x N regardless of the matrix size.
+
+    Args:
+        dist_matrix (np.ndarray or torch.Tensor): Square (N, N) distance matrix.
+        threshold (float): Pairs with a distance below the threshold become edges.
+        block_size (int): Number of rows processed per block.
+
+    Returns:
+        tuple of np.ndarray: Row indices, column indices and float64 distances
+        of all pairs i < j, in row-major order.
     """
     num_nodes = dist_matrix.shape[0]
-    edges = []
+    sources, targets, weights = [], [], []
 
-    for i in range(num_nodes):
-        for j in range(i + 1, num_nodes):
-            distance = dist_matrix[i, j]
-            if distance < threshold:
-                edges.append((nodeslist[i], nodeslist[j], float(distance)))
+    for start in range(0, num_nodes, block_size):
+        stop = min(start + block_size, num_nodes)
 
-    # Convert to DataFrame
-    edge_df = pd.DataFrame(edges, columns=['source', 'target', 'weight'])
-    return edge_df
+        # Only columns right of the diagonal can hold edges for this block
+        block = _to_numpy(dist_matrix[start:stop, start:])
+        mask = np.triu(block < threshold, k=1)
+
+        rows, cols = np.nonzero(mask)
+        sources.append(rows + start)
+        targets.append(cols + start)
+        weights.append(block[rows, cols].astype(np.float64))
+
+    if not sources:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+    return np.concatenate(sources), np.concatenate(targets), np.concatenate(weights)
+
+
+def get_edges(dist_matrix, threshold, nodeslist, block_size=1024):
+    """
+    Construct an edge list from a distance matrix based on a threshold.
+
+    Args:
+        dist_matrix (np.ndarray or torch.Tensor): Square (N, N) distance matrix.
+        threshold (float): Pairs with a distance below the threshold become edges.
+        nodeslist (list of str): Node ids in the order of the matrix rows.
+        block_size (int): Number of rows processed per block, see get_edge_arrays().
+
+    Returns:
+        pd.DataFrame: DataFrame with columns ['source', 'target', 'weight'].
+    """
+    sources, targets, weights = get_edge_arrays(dist_matrix, threshold, block_size)
+    return _edges_to_frame(sources, targets, weights, nodeslist)
 
 
-def get_nodes(filenames, images):
+def get_neighbour_arrays(features, radius=None, k=None, method="exact", block_size=1024):
+    """
+    Find radius or k-nearest-neighbour pairs without building a distance matrix.
+
+    Neighbours are queried block by block, so memory grows
+    with the number of nodes and edges, not N x N.
+
+    Args:
+        features (np.ndarray or torch.Tensor): Feature matrix of shape (N, D).
+        radius (float): Keep pairs with a Euclidean distance below the radius.
+        k (int): Keep the k nearest neighbours of each node.
+            If radius and k are both given, the k neighbours are filtered by the radius.
+        method (str): 'exact' (blockwise distances with matrix products),
+            'hnsw' (approximate, requires pip install hnswlib and k, for very large N)
+            or 'balltree' (sklearn, exact). Ball trees only suit low-dimensional features,
+            on embeddings such as 768-dimensional ViT features they are much slower than 'exact'.
+        block_size (int): Number of query rows processed at once.
+
+    Returns:
+        tuple of np.ndarray: Row indices, column indices and float64 distances
+        of all unique pairs i < j, in row-major order.
+    """
+    if radius is None and k is None:
+        raise ValueError("Either radius or k must be provided.")
+
+    # No copy for float32 input, e.g. a memory-mapped embedding matrix
+    features = _to_numpy(features).astype(np.float32, copy=False)
+    num_nodes = features.shape[0]
+
+    if method == "exact":
+        query = _exact_neighbours(features)
+    elif method == "balltree":
+        query = _balltree_neighbours(features)
+    elif method == "hnsw":
+        if k is None:
+            raise ValueError("The hnsw method needs k as an upper bound for radius queries.")
+        query = _hnsw_neighbours(features)
+    else:
+        raise ValueError(f"Unknown method: {method}")
+
+    sources, targets, weights = [], [], []
+    for start in range(0, num_nodes, block_size):
+        stop = min(start + block_size, num_nodes)
+        rows, cols, dists = query(start, stop, radius, k)
+
+        keep = rows != cols
+        if radius is not None:
+            keep &= dists < radius
+
+        sources.append(rows[keep])
+        targets.append(cols[keep])
+        weights.append(dists[keep])
+
+    if not sources:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+    sources = np.concatenate(sources)
+    targets = np.concatenate(targets)
+    weights = np.concatenate(weights).astype(np.float64)
+
+    # Undirected graph: store each pair once as (min, max), sorted row-major
+    lower = np.minimum(sources, targets).astype(np.int64)
+    upper = np.maximum(sources, targets).astype(np.int64)
+    keys, first = np.unique(lower * num_nodes + upper, return_index=True)
+
+    return keys // num_nodes, keys % num_nodes, weights[first]
+
+
+def get_neighbour_edges(features, nodeslist, radius=None, k=None, method="exact", block_size=1024):
+    """
+    Construct a radius or k-nearest-neighbour edge list from a feature matrix.
+
+    Args:
+        features (np.ndarray or torch.Tensor): Feature matrix of shape (N, D).
+        nodeslist (list of str): Node ids in the order of the feature rows.
+        radius (float): Keep pairs with a Euclidean distance below the radius.
+        k (int): Keep the k nearest neighbours of each node.
+        method (str): 'exact', 'hnsw' or 'balltree', see get_neighbour_arrays().
+        block_size (int): Number of query rows processed at once.
+
+    Returns:
+        pd.DataFrame: DataFrame with columns ['source', 'target', 'weight'].
+    """
+    sources, targets, weights = get_neighbour_arrays(features, radius, k, method, block_size)
+    return _edges_to_frame(sources, targets, weights, nodeslist)
+
+
+def get_radius_statistics(features, radii, sample_size=2000, seed=0):
+    """
+    Predict the size of radius graphs from the distances between a random sample of nodes.
+
+    The fraction of sampled pairs closer than a radius estimates the fraction of all pairs
+    that become edges, without building the graph or the full distance matrix.
+    Small fractions need larger samples, e.g. 2000 nodes give two million pairs.
+
+    Args:
+        features (np.ndarray or torch.Tensor): Feature matrix of shape (N, D).
+        radii (list of float): Candidate radii.
+        sample_size (int): Number of sampled nodes.
+        seed (int): Seed of the sample.
+
+    Returns:
+        pd.DataFrame: Predicted number of edges and average degree for each radius,
+        with columns ['radius', 'edges', 'degree'].
+    """
+    num_nodes = features.shape[0]
+    distances = np.sort(_sample_distances(features, sample_size, seed))
+    radii = np.asarray(radii, dtype=np.float64)
+
+    # Edges are pairs with a distance below the radius, as in get_neighbour_arrays()
+    fractions = np.searchsorted(distances, radii, side="left") / max(len(distances), 1)
+    return pd.DataFrame({
+        'radius': radii,
+        'edges': np.rint(fractions * num_nodes * (num_nodes - 1) / 2).astype(np.int64),
+        'degree': fractions * (num_nodes - 1)
+    })
+
+
+def estimate_radius(features, degree=None, edges=None, sample_size=2000, seed=0):
+    """
+    Estimate the radius resulting in a graph of the given density, see get_radius_statistics().
+
+    Args:
+        features (np.ndarray or torch.Tensor): Feature matrix of shape (N, D).
+        degree (float): Target average number of neighbours per node.
+        edges (int): Target number of edges, instead of the degree.
+        sample_size (int): Number of sampled nodes.
+        seed (int): Seed of the sample.
+
+    Returns:
+        float: Radius for get_neighbour_arrays() or get_neighbour_edges().
+    """
+    if (degree is None) == (edges is None):
+        raise ValueError("Either degree or edges must be provided.")
+
+    num_nodes = features.shape[0]
+    if edges is not None:
+        degree = 2 * edges / num_nodes
+
+    distances = _sample_distances(features, sample_size, seed)
+    if len(distances) == 0:
+        raise ValueError("At least two nodes are needed to estimate a radius.")
+
+    fraction = min(1.0, degree / max(num_nodes - 1, 1))
+    return float(np.quantile(distances, fraction))
+
+
+def get_nodes(filenames, images=None, filepaths=None, size=(100, 100), workers=None, chunksize=16):
     """
     Create a DataFrame with filenames and base64-encoded image data URLs.
 
+    Pass either the thumbnails as PIL images, or the image file paths.
+    File paths are decoded, thumbnailed and encoded in a process pool,
+    so the images never need to be held in memory by the caller.
+    On Windows, call it inside an `if __name__ == "__main__":` block when running a script directly.
+
     Args:
         filenames (list of str): List of image filenames.
         images (list of PIL.Image.Image): List of PIL image thumbnails.
+        filepaths (list of str): List of image file paths, in the order of the filenames.
+        size (tuple): Maximum thumbnail size when encoding from file paths.
+        workers (int): Number of worker processes, defaults to the number of CPUs.
+            Set to 1 to encode in the current process.
+        chunksize (int): Number of files sent to a worker at once.
+
+    Returns:
+        pd.DataFrame: DataFrame with columns ['id', 'imgdata'].
+    """
+    if filepaths is not None:
+        data_urls = images_to_data_urls(filepaths, size, format="PNG", fit="thumbnail",
+                                        workers=workers, chunksize=chunksize)
+    else:
+        data_urls = [_png_data_url(img) for img in images]
+
+    return pd.DataFrame({'id': list(filenames), 'imgdata': data_urls})
+
+
+def get_adjacency(sources, targets, num_nodes, weights=None):
+    """
+    Build a symmetric sparse adjacency matrix from edge index arrays, e.g. of get_neighbour_arrays().
+
+    Args:
+        sources (np.ndarray): Row indices of the edges.
+        targets (np.ndarray): Column indices of the edges.
+        num_nodes (int): Number of nodes, including nodes without edges.
+        weights (np.ndarray): Edge weights as similarities, higher is closer. None weights all edges with 1.
+            Distances need to be converted first, e.g. radius - distance.
 
     Returns:
-        pd.DataFrame: DataFrame with columns ['filename', 'imgdata'].
+        scipy.sparse.csr_matrix: (N, N) matrix with each undirected edge in both directions.
     """
-    data = []
+    sources = np.asarray(sources, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.int64)
+    weights = np.ones(len(sources)) if weights is None else np.asarray(weights, dtype=np.float64)
 
-    for fname, img in zip(filenames, images):
-        # Save image to a bytes buffer in PNG format
-        buffer = BytesIO()
-        img.save(buffer, format="PNG")
-        buffer.seek(0)
+    keep = sources != targets
+    sources, targets, weights = sources[keep], targets[keep], weights[keep]
+    adjacency = coo_matrix((np.concatenate([weights, weights]),
+                            (np.concatenate([sources, targets]), np.concatenate([targets, sources]))),
+                           shape=(num_nodes, num_nodes))
+    return adjacency.tocsr()
 
-        # Encode as base64
-        img_b64 = base64.b64encode(buffer.read()).decode('utf-8')
-        data_url = f"data:image/png;base64,{img_b64}"
 
-        data.append({'id': fname, 'imgdata': data_url})
+def get_clusters(adjacency, method="louvain", resolution=1.0, seed=0, max_levels=20, max_iterations=50):
+    """
+    Cluster the nodes of a sparse graph.
+
+    The Louvain method alternates between moving nodes to the neighbouring community
+    with the highest modularity gain and merging the communities into nodes of a smaller graph.
+    Moves are evaluated for all nodes at once with sparse matrix operations;
+    a random half of the improving nodes moves in each iteration,
+    so that neighbours do not swap communities back and forth.
+    After the first iteration, only the neighbours of moved nodes are evaluated again.
+
+    Args:
+        adjacency (scipy.sparse matrix): Symmetric (N, N) adjacency matrix, see get_adjacency().
+        method (str): 'louvain' for community detection or 'components' for connected components.
+        resolution (float): Louvain resolution, higher values result in smaller clusters.
+        seed (int): Seed of the random moves.
+        max_levels (int): Maximum number of merge levels.
+        max_iterations (int): Maximum number of move iterations per level.
+
+    Returns:
+        np.ndarray: Cluster id of each node, numbered by decreasing cluster size.
+    """
+    adjacency = csr_matrix(adjacency, dtype=np.float64)
+
+    if method == "components":
+        _, labels = connected_components(adjacency, directed=False)
+    elif method == "louvain":
+        labels = _louvain(adjacency, resolution, np.random.default_rng(seed), max_levels, max_iterations)
+    else:
+        raise ValueError(f"Unknown method: {method}")
+
+    # Number clusters by size, the largest first
+    sizes = np.bincount(labels)
+    order = np.argsort(-sizes, kind="stable")
+    ranks = np.empty_like(order)
+    ranks[order] = np.arange(len(order))
+    return ranks[labels]
+
+
+def get_modularity(adjacency, labels, resolution=1.0):
+    """
+    Modularity of a clustering, to compare resolutions or methods.
+
+    Returns:
+        float: Modularity between -0.5 and 1, higher values mean denser clusters.
+    """
+    adjacency = csr_matrix(adjacency, dtype=np.float64)
+    total = adjacency.sum()
+    if total == 0:
+        return 0.0
+
+    coo = adjacency.tocoo()
+    internal = np.bincount(labels[coo.row], weights=coo.data * (labels[coo.row] == labels[coo.col]))
+    degrees = np.bincount(labels, weights=np.asarray(adjacency.sum(axis=1)).ravel())
+    return float(internal.sum() / total - resolution * np.sum((degrees / total) ** 2))
 
-    return pd.DataFrame(data)
 
 def create_gexf(edge_list_df, node_list_df, output_path="graph.gexf"):
     """
@@ -56,18 +339,324 @@ def create_gexf(edge_list_df, node_list_df, output_path="graph.gexf"):
     Args:
         edge_list_df (pd.DataFrame): DataFrame with columns ['source', 'target', 'weight'].
         node_list_df (pd.DataFrame): DataFrame with columns ['id', 'imgdata'].
+            Further columns, e.g. cluster ids, are written as node attributes.
+        output_path (str): Path to save the GEXF file.
+    """
+    columns = [column for column in node_list_df.columns if column not in ('id', 'imgdata')]
+    nodes = ({'id': node_id, 'img': imgdata, **dict(zip(columns, values))}
+             for node_id, imgdata, *values in zip(node_list_df['id'], node_list_df['imgdata'],
+                                                  *(node_list_df[column] for column in columns)))
+    node_attributes = {'img': 'string'}
+    node_attributes.update({column: _gexf_dtype(node_list_df[column]) for column in columns})
+    write_gexf(edge_list_df, nodes, output_path, node_attributes=node_attributes)
+
+
+def write_gexf(edges, nodes, output_path="graph.gexf", compress=None, node_attributes=None):
+    """
+    Stream nodes and edges to an undirected GEXF file.
+
+    Each node and edge is serialized and written as soon as it is read,
+    so memory stays flat regardless of the graph size.
+
+    Args:
+        edges (pd.DataFrame or iterable): DataFrame with columns ['source', 'target', 'weight'],
+            or an iterable of dicts or (source, target, weight) tuples.
+        nodes (pd.DataFrame or iterable): DataFrame with an 'id' column, or an iterable of dicts.
+            All other columns or keys are written as node attributes.
         output_path (str): Path to save the GEXF file.
+        compress (bool): Gzip the output. By default, compress if the path ends with '.gz'.
+        node_attributes (dict): Attribute titles mapped to GEXF types ('string', 'integer',
+            'double', 'boolean'). By default, inferred from the first node.
     """
-    # Create an undirected graph
-    G = nx.Graph()
+    if compress is None:
+        compress = str(output_path).endswith('.gz')
+
+    nodes = _iter_records(nodes)
+    if node_attributes is None:
+        first = next(nodes, None)
+        if first is not None:
+            nodes = itertools.chain([first], nodes)
+            node_attributes = {key: _gexf_type(value) for key, value in first.items() if key != 'id'}
+        else:
+            node_attributes = {}
+
+    with (gzip.open if compress else open)(output_path, 'wb') as f:
+        with etree.xmlfile(f, encoding='utf-8') as xf:
+            xf.write_declaration()
+            with xf.element('gexf', nsmap={None: GEXF_NS}, version='1.2'):
+                with xf.element('meta', lastmodifieddate=date.today().isoformat()):
+                    creator = etree.Element('creator')
+                    creator.text = 'graphim'
+                    xf.write(creator)
+
+                with xf.element('graph', defaultedgetype='undirected', mode='static'):
+                    with xf.element('attributes', {'class': 'node', 'mode': 'static'}):
+                        for title, attr_type in node_attributes.items():
+                            xf.write(etree.Element('attribute', id=title, title=title, type=attr_type))
+
+                    with xf.element('nodes'):
+                        for node in nodes:
+                            xf.write(_gexf_node(node, node_attributes))
+
+                    with xf.element('edges'):
+                        for edge_id, edge in enumerate(_iter_records(edges, ['source', 'target', 'weight'])):
+                            element = etree.Element('edge', id=str(edge_id),
+                                                    source=str(edge['source']), target=str(edge['target']))
+                            if edge.get('weight') is not None:
+                                element.set('weight', str(edge['weight']))
+                            xf.write(element)
+
+
+def _exact_neighbours(features):
+    """Brute force neighbour query computing one block of distances at a time."""
+    # Converted once, not for every block
+    features = features.astype(np.float64)
+    sq_norms = np.einsum('ij,ij->i', features, features)
+
+    def query(start, stop, radius, k):
+        sq_dists = sq_norms[start:stop, None] + sq_norms[None, :] - 2 * features[start:stop] @ features.T
+        dists = np.sqrt(np.maximum(sq_dists, 0))
+        dists[np.arange(stop - start), np.arange(start, stop)] = 0
+
+        if k is None:
+            rows, cols = np.nonzero(dists < radius)
+            return rows + start, cols, dists[rows, cols]
+
+        n = min(k + 1, dists.shape[1])
+        cols = np.argpartition(dists, n - 1, axis=1)[:, :n]
+        rows = np.broadcast_to(np.arange(start, stop)[:, None], cols.shape)
+        return _first_k(rows, cols, np.take_along_axis(dists, cols, axis=1), k)
+
+    return query
+
+
+def _sample_distances(features, sample_size, seed):
+    """Euclidean distances of all pairs in a random sample of feature rows."""
+    num_nodes = features.shape[0]
+    rng = np.random.default_rng(seed)
+
+    # Sorted rows read memory-mapped matrices front to back
+    sample = np.sort(rng.choice(num_nodes, min(sample_size, num_nodes), replace=False))
+    sample = _to_numpy(features[sample]).astype(np.float64)
+
+    sq_norms = np.einsum('ij,ij->i', sample, sample)
+    sq_dists = sq_norms[:, None] + sq_norms[None, :] - 2 * sample @ sample.T
+    rows, cols = np.triu_indices(len(sample), k=1)
+    return np.sqrt(np.maximum(sq_dists[rows, cols], 0))
+
+
+def _balltree_neighbours(features):
+    """Exact neighbour query using a scikit-learn ball tree."""
+    from sklearn.neighbors import BallTree
+
+    tree = BallTree(features)
+
+    def query(start, stop, radius, k):
+        if k is None:
+            ind, dist = tree.query_radius(features[start:stop], radius, return_distance=True)
+            counts = [len(x) for x in ind]
+            rows = np.repeat(np.arange(start, stop), counts)
+            if not counts or sum(counts) == 0:
+                return rows, np.empty(0, dtype=np.int64), np.empty(0)
+            return rows, np.concatenate(ind), np.concatenate(dist)
+
+        dist, cols = tree.query(features[start:stop], k=min(k + 1, len(features)))
+        rows = np.broadcast_to(np.arange(start, stop)[:, None], cols.shape)
+        return _first_k(rows, cols, dist, k)
+
+    return query
+
+
+def _hnsw_neighbours(features, ef=200, m=16):
+    """Approximate neighbour query using an hnswlib index."""
+    import hnswlib
+
+    index = hnswlib.Index(space='l2', dim=features.shape[1])
+    index.init_index(max_elements=len(features), ef_construction=ef, M=m)
+    index.add_items(features, np.arange(len(features)))
+
+    def query(start, stop, radius, k):
+        n = min(k + 1, len(features))
+        index.set_ef(max(ef, n))
+        cols, sq_dists = index.knn_query(features[start:stop], k=n)
+        rows = np.broadcast_to(np.arange(start, stop)[:, None], cols.shape)
+        # hnswlib returns squared L2 distances
+        return _first_k(rows, cols.astype(np.int64), np.sqrt(sq_dists), k)
+
+    return query
+
+
+def _first_k(rows, cols, dists, k):
+    """Drop self matches from (n, k + 1) neighbour arrays and keep k per row."""
+    keep = rows != cols
+    keep &= np.cumsum(keep, axis=1) <= k
+    return rows[keep], cols[keep], dists[keep]
+
+
+def _edges_to_frame(sources, targets, weights, nodeslist):
+    """Map edge index arrays to node ids."""
+    if len(sources) == 0:
+        return pd.DataFrame([], columns=['source', 'target', 'weight'])
+
+    nodes = np.asarray(nodeslist, dtype=object)
+    edge_df = pd.DataFrame({
+        'source': nodes[sources],
+        'target': nodes[targets],
+        'weight': weights
+    })
+    return edge_df
+
+
+def _to_numpy(matrix):
+    """Convert a torch tensor or array-like to a numpy array."""
+    if hasattr(matrix, 'detach'):
+        matrix = matrix.detach().cpu().numpy()
+    return np.asarray(matrix)
+
+
+def _gexf_node(node, node_attributes):
+    """Build a GEXF node element with its attribute values."""
+    node_id = str(node['id'])
+    element = etree.Element('node', id=node_id, label=node_id)
+
+    attvalues = None
+    for title in node_attributes:
+        value = node.get(title)
+        if value is None or (isinstance(value, (float, np.floating)) and np.isnan(value)):
+            continue
+        if attvalues is None:
+            attvalues = etree.SubElement(element, 'attvalues')
+        if isinstance(value, (bool, np.bool_)):
+            value = str(bool(value)).lower()
+        etree.SubElement(attvalues, 'attvalue', {'for': title, 'value': str(value)})
+
+    return element
+
+
+def _gexf_dtype(series):
+    """Map the dtype of a pandas column to a GEXF attribute type."""
+    if pd.api.types.is_bool_dtype(series):
+        return 'boolean'
+    if pd.api.types.is_integer_dtype(series):
+        return 'integer'
+    if pd.api.types.is_float_dtype(series):
+        return 'double'
+    return 'string'
+
+
+def _gexf_type(value):
+    """Map a Python value to a GEXF attribute type."""
+    if isinstance(value, (bool, np.bool_)):
+        return 'boolean'
+    if isinstance(value, (int, np.integer)):
+        return 'integer'
+    if isinstance(value, (float, np.floating)):
+        return 'double'
+    return 'string'
+
+
+def _louvain(adjacency, resolution, rng, max_levels, max_iterations):
+    """Louvain community detection, alternating local moves and aggregation."""
+    labels = np.arange(adjacency.shape[0])
+    graph = adjacency
+    for _ in range(max_levels):
+        communities = _local_moves(graph, resolution, rng, max_iterations)
+        _, communities = np.unique(communities, return_inverse=True)
+        num_communities = communities.max() + 1 if len(communities) else 0
+        if num_communities == graph.shape[0]:
+            break
+
+        # Merge each community into one node, internal edges become self loops
+        labels = communities[labels]
+        membership = csr_matrix((np.ones(len(communities)), (np.arange(len(communities)), communities)),
+                                shape=(len(communities), num_communities))
+        graph = (membership.T @ graph @ membership).tocsr()
+
+    return labels
+
+
+def _local_moves(graph, resolution, rng, max_iterations):
+    """Move nodes to the neighbouring community with the highest modularity gain, all nodes at once."""
+    num_nodes = graph.shape[0]
+    total = graph.sum()
+    communities = np.arange(num_nodes)
+    if total == 0:
+        return communities
+
+    degrees = np.asarray(graph.sum(axis=1)).ravel()
+    rows = np.repeat(np.arange(num_nodes), np.diff(graph.indptr))
+    off_diagonal = rows != graph.indices
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows[off_diagonal], minlength=num_nodes))])
+    neighbours = csr_matrix((graph.data[off_diagonal], graph.indices[off_diagonal], indptr), shape=graph.shape)
+
+    # Only nodes next to a moved node are evaluated again
+    active = np.ones(num_nodes, dtype=bool)
+    for _ in range(max_iterations):
+        nodes = np.flatnonzero(active)
+        node_degrees = degrees[nodes]
+        node_communities = communities[nodes]
+        totals = np.bincount(communities, weights=degrees, minlength=num_nodes)
+
+        # Weight of the links from each node to each neighbouring community
+        rows = neighbours[nodes]
+        links = csr_matrix((rows.data, communities[rows.indices], rows.indptr),
+                           shape=(len(nodes), num_nodes), copy=True)
+        links.sum_duplicates()
+        counts = np.diff(links.indptr)
+        link_rows = np.repeat(np.arange(len(nodes)), counts)
+        link_degrees = node_degrees[link_rows]
+        own = links.indices == node_communities[link_rows]
+
+        # Modularity gain of joining each community, leaving the own community first
+        gains = links.data - resolution * link_degrees * (totals[links.indices] - own * link_degrees) / total
+
+        stay = np.zeros(len(nodes))
+        stay[link_rows[own]] = links.data[own]
+        stay -= resolution * node_degrees * (totals[node_communities] - node_degrees) / total
+
+        # Best community of each node, the first one on ties
+        best = np.full(len(nodes), -np.inf)
+        linked = counts > 0
+        best[linked] = np.maximum.reduceat(gains, links.indptr[:-1][linked])
+        candidates = np.flatnonzero(gains >= best[link_rows])
+        candidate_rows = link_rows[candidates]
+        first = np.ones(len(candidates), dtype=bool)
+        first[1:] = candidate_rows[1:] != candidate_rows[:-1]
+        targets = node_communities.copy()
+        targets[candidate_rows[first]] = links.indices[candidates[first]]
+
+        improving = (best > stay + 1e-12) & (targets != node_communities)
+        if not improving.any():
+            break
+        move = improving & (rng.random(len(nodes)) < 0.5)
+        communities[nodes[move]] = targets[move]
+
+        moved = np.zeros(num_nodes)
+        moved[nodes[move]] = 1
+        active = neighbours @ moved > 0
+        active[nodes[improving & ~move]] = True
+
+    return communities
+
+
+def _iter_records(table, columns=None):
+    """Iterate over DataFrame rows, dicts or tuples as dicts."""
+    if isinstance(table, pd.DataFrame):
+        columns = list(table.columns)
+        for row in table.itertuples(index=False, name=None):
+            yield dict(zip(columns, row))
+        return
 
-    # Add nodes with attributes
-    for _, row in node_list_df.iterrows():
-        G.add_node(row['id'], img=row['imgdata'])
+    for record in table:
+        if isinstance(record, dict):
+            yield record
+        else:
+            yield dict(zip(columns, record))
 
-    # Add edges with weights
-    for _, row in edge_list_df.iterrows():
-        G.add_edge(row['source'], row['target'], weight=row['weight'])
 
-    # Write to GEXF
-    nx.write_gexf(G, output_path)
\ No newline at end of file
+def _png_data_url(img):
+    """Encode a PIL image as PNG data URL."""
+    buffer = BytesIO()
+    img.save(buffer, format="PNG")
+    img_b64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
+    return f"data:image/png;base64,{img_b64}"
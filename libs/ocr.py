@@ -0,0 +1,169 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+# The EasyOCR reader and prefilter settings of the current worker process
+_reader = None
+_prefilter = None
+_prefilter_size = 640
+
+
+def read_text(filepaths, languages=("de",), workers=1, threads=None, gpu=None, chunksize=4,
+              prefilter=None, prefilter_size=640):
+    """
+    Extract the text of image files with EasyOCR, optionally sharded over worker processes.
+
+    Each worker loads its own reader once and processes the files it receives.
+    Torch threads are limited per worker, so that workers do not compete for the same cores.
+    Workers are spawned on all platforms, so with more than one worker,
+    call it inside an `if __name__ == "__main__":` block when running a script directly.
+
+    Args:
+        filepaths (list of str): Paths to the image files.
+        languages (list of str): EasyOCR language codes.
+        workers (int): Number of worker processes. 1 runs the reader in the current process.
+        threads (int): Torch threads per worker, defaults to the CPU count divided by the workers.
+        gpu (bool): Use the GPU. Defaults to True for a single process and False for workers.
+        chunksize (int): Number of files sent to a worker at once.
+        prefilter (str): Skip full OCR on images without text, see read_image().
+            None, "detect" or "edges".
+        prefilter_size (int): Longest side of the downscaled image used by the prefilter.
+
+    Returns:
+        list of str: The extracted text in the order of the file paths, None for unreadable files.
+    """
+    if gpu is None:
+        gpu = workers == 1
+    if threads is None:
+        threads = max(1, (os.cpu_count() or 1) // workers)
+
+    if workers == 1:
+        _init_worker(languages, threads, gpu, prefilter, prefilter_size)
+        return [_read_file(filepath) for filepath in tqdm(filepaths)]
+
+    # Spawned workers do not inherit the thread pools of the parent process
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=_init_worker, initargs=(languages, threads, gpu, prefilter, prefilter_size)) as executor:
+        return list(tqdm(executor.map(_read_file, filepaths, chunksize=chunksize), total=len(filepaths)))
+
+
+def read_image(reader, img, prefilter=None, prefilter_size=640):
+    """
+    Extract the text of an image, optionally skipping images without text.
+
+    Prefilters:
+    - "detect" runs only the EasyOCR text detector on a downscaled image.
+      Images without detected regions are skipped, otherwise the
+      recognizer runs on the detected regions of the full image.
+    - "edges" skips images with few word-like edge blobs (see has_text_edges())
+      and runs the full OCR on the others.
+
+    Args:
+        reader (easyocr.Reader): The reader.
+        img (np.ndarray): RGB image.
+        prefilter (str): None, "detect" or "edges".
+        prefilter_size (int): Longest side of the downscaled image used by the prefilter.
+
+    Returns:
+        str: The recognized text, empty if no text was found.
+    """
+    if prefilter == "detect":
+        horizontal_list, free_list = detect_text(reader, img, prefilter_size)
+        if not horizontal_list and not free_list:
+            return ""
+        result = reader.recognize(img, horizontal_list=horizontal_list, free_list=free_list)
+    elif prefilter == "edges":
+        if not has_text_edges(img, prefilter_size):
+            return ""
+        result = reader.readtext(img)
+    elif prefilter is None:
+        result = reader.readtext(img)
+    else:
+        raise ValueError(f"Unknown prefilter: {prefilter}")
+
+    return ' '.join([text[1] for text in result])
+
+
+def detect_text(reader, img, max_size=640):
+    """
+    Detect text regions on a downscaled image.
+
+    Args:
+        reader (easyocr.Reader): The reader.
+        img (np.ndarray): RGB image.
+        max_size (int): Longest side of the downscaled image.
+
+    Returns:
+        tuple: Horizontal boxes [x_min, x_max, y_min, y_max] and free boxes (four [x, y] points)
+        in the coordinates of the full image, as expected by reader.recognize().
+    """
+    height, width = img.shape[:2]
+    scale = min(1.0, max_size / max(height, width))
+    if scale < 1.0:
+        small = np.asarray(Image.fromarray(img).resize((round(width * scale), round(height * scale))))
+    else:
+        small = img
+
+    horizontal_list, free_list = reader.detect(small)
+    horizontal_list = [[round(v / scale) for v in box] for box in horizontal_list[0]]
+    free_list = [[[round(x / scale), round(y / scale)] for x, y in box] for box in free_list[0]]
+    return horizontal_list, free_list
+
+
+def has_text_edges(img, max_size=640, min_words=2):
+    """
+    Cheap heuristic whether an image likely contains text.
+
+    On a downscaled grayscale image, strong edges are connected horizontally into word blobs.
+    Blobs that are wider than high, not too large and densely filled with edges count as words.
+
+    Args:
+        img (np.ndarray): RGB image.
+        max_size (int): Longest side of the downscaled image.
+        min_words (int): Number of word-like blobs needed.
+
+    Returns:
+        bool: True if the image likely contains text.
+    """
+    import cv2
+
+    height, width = img.shape[:2]
+    scale = min(1.0, max_size / max(height, width))
+    gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+    if scale < 1.0:
+        gray = cv2.resize(gray, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+
+    gradient = cv2.morphologyEx(gray, cv2.MORPH_GRADIENT, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3)))
+    _, edges = cv2.threshold(gradient, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    words = cv2.morphologyEx(edges, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT, (9, 1)))
+
+    _, _, stats, _ = cv2.connectedComponentsWithStats(words, connectivity=8)
+    x, y, w, h, area = stats[1:].T
+    is_word = (h >= 8) & (h <= gray.shape[0] / 5) & (w >= 1.5 * h) & (area > 0.45 * w * h)
+    return int(is_word.sum()) >= min_words
+
+
+def _init_worker(languages, threads, gpu, prefilter=None, prefilter_size=640):
+    """Load the reader once per process."""
+    global _reader, _prefilter, _prefilter_size
+    import torch
+    import easyocr
+
+    torch.set_num_threads(threads)
+    _reader = easyocr.Reader(list(languages), gpu=gpu, verbose=False)
+    _prefilter = prefilter
+    _prefilter_size = prefilter_size
+
+
+def _read_file(filepath):
+    """Run OCR on one file and join the recognized text."""
+    try:
+        with Image.open(filepath) as img:
+            img = np.asarray(img.convert("RGB"))
+        return read_image(_reader, img, _prefilter, _prefilter_size)
+    except Exception:
+        return None
@@ -0,0 +1,179 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import argparse
+import pandas as pd
+
+# Default location of the cache database
+RESPONSE_CACHE = "data/cache/responses.sqlite"
+
+
+class ResponseCache:
+    """
+    Persistent cache for API responses about images, stored in SQLite.
+
+    Entries are keyed by the image content hash, the prompt, the model name
+    and further request parameters, so a renamed image still hits the cache,
+    while changing the prompt or parameters results in a new request.
+    """
+
+    def __init__(self, path=RESPONSE_CACHE):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                image_hash TEXT,
+                prompt TEXT,
+                model TEXT,
+                params TEXT,
+                response TEXT,
+                created REAL,
+                hits INTEGER DEFAULT 0
+            )
+        """)
+        self.db.commit()
+
+    @staticmethod
+    def key(image_hash, prompt, model, params=None):
+        """Combine the request properties to a cache key."""
+        data = json.dumps([image_hash, prompt, model, params or {}], sort_keys=True)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def get(self, image_hash, prompt, model, params=None):
+        """
+        Look up a cached response.
+
+        Returns:
+            The response as stored by put() or None if there is no entry.
+        """
+        key = self.key(image_hash, prompt, model, params)
+        row = self.db.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+
+        self.db.execute("UPDATE responses SET hits = hits + 1 WHERE key = ?", (key,))
+        self.db.commit()
+        return json.loads(row[0])
+
+    def put(self, image_hash, prompt, model, response, params=None):
+        """Store a JSON serializable response, replacing an existing entry."""
+        key = self.key(image_hash, prompt, model, params)
+        self.db.execute(
+            "INSERT OR REPLACE INTO responses (key, image_hash, prompt, model, params, response, created) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (key, image_hash, prompt, model, json.dumps(params or {}, sort_keys=True),
+             json.dumps(response, ensure_ascii=False), time.time())
+        )
+        self.db.commit()
+
+    def stats(self):
+        """
+        Summarize the cache by model.
+
+        Returns:
+            pd.DataFrame: Number of entries, hits and the oldest and newest entry per model.
+        """
+        stats = pd.read_sql_query(
+            "SELECT model, COUNT(*) AS entries, SUM(hits) AS hits, "
+            "MIN(created) AS oldest, MAX(created) AS newest FROM responses GROUP BY model",
+            self.db
+        )
+        stats['oldest'] = pd.to_datetime(stats['oldest'], unit='s')
+        stats['newest'] = pd.to_datetime(stats['newest'], unit='s')
+        return stats
+
+    def entries(self, model=None):
+        """
+        List the cache entries.
+
+        Args:
+            model (str): Only list entries of this model.
+
+        Returns:
+            pd.DataFrame: One row per entry, the response as JSON string.
+        """
+        query = "SELECT key, image_hash, prompt, model, params, response, created, hits FROM responses"
+        params = ()
+        if model is not None:
+            query += " WHERE model = ?"
+            params = (model,)
+
+        entries = pd.read_sql_query(query, self.db, params=params)
+        entries['created'] = pd.to_datetime(entries['created'], unit='s')
+        return entries
+
+    def expire(self, max_age_days=None, model=None):
+        """
+        Delete entries.
+
+        Args:
+            max_age_days (float): Delete entries older than this, None deletes regardless of age.
+            model (str): Only delete entries of this model.
+
+        Returns:
+            int: Number of deleted entries.
+        """
+        conditions, params = [], []
+        if max_age_days is not None:
+            conditions.append("created < ?")
+            params.append(time.time() - max_age_days * 86400)
+        if model is not None:
+            conditions.append("model = ?")
+            params.append(model)
+
+        query = "DELETE FROM responses"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+
+        deleted = self.db.execute(query, params).rowcount
+        self.db.commit()
+        return deleted
+
+    def export(self, output_file, model=None):
+        """
+        Export the entries to a CSV or JSON lines file, depending on the file extension.
+
+        Returns:
+            int: Number of exported entries.
+        """
+        entries = self.entries(model)
+        if output_file.endswith((".jsonl", ".json")):
+            entries['response'] = entries['response'].map(json.loads)
+            entries['params'] = entries['params'].map(json.loads)
+            entries.to_json(output_file, orient="records", lines=True, date_format="iso", force_ascii=False)
+        else:
+            entries.to_csv(output_file, index=False)
+        return len(entries)
+
+    def close(self):
+        self.db.close()
+
+
+if __name__ == "__main__":
+    # Command line tools, e.g. python -m libs.responsecache stats
+    parser = argparse.ArgumentParser(description="Inspect, expire and export the API response cache")
+    parser.add_argument("command", choices=["stats", "expire", "export"])
+    parser.add_argument("--path", default=RESPONSE_CACHE, help="Cache database")
+    parser.add_argument("--model", default=None, help="Only entries of this model")
+    parser.add_argument("--days", type=float, default=None, help="expire: delete entries older than this")
+    parser.add_argument("--all", action="store_true", help="expire: delete all entries of all models")
+    parser.add_argument("--output", default="responses.jsonl", help="export: CSV or JSON lines file")
+    args = parser.parse_args()
+
+    # Cached responses were paid for, never delete all of them by accident
+    if args.command == "expire" and args.days is None and args.model is None and not args.all:
+        parser.error("expire needs --days, --model or --all")
+
+    cache = ResponseCache(args.path)
+    if args.command == "stats":
+        print(cache.stats().to_string(index=False))
+    elif args.command == "expire":
+        print(f"Deleted {cache.expire(args.days, args.model)} entries.")
+    elif args.command == "export":
+        print(f"Exported {cache.export(args.output, args.model)} entries to {args.output}.")
+    cache.close()
@@ -1,44 +1,115 @@
 #%%
 # Add base64 encoded images as data URLS to a csv file
+#
+# Small files can be converted in memory.
+# Large files are processed in chunks: the images of each chunk are encoded
+# in a process pool and the finished chunk is appended to the output file.
+# After a crash, the chunked conversion resumes from the last completed chunk.
 
 import pandas as pd
 import os
-import base64
-from PIL import Image
-from io import BytesIO
+import json
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 tqdm.pandas()
 
-#%% Load files
+from libs import images
+
+#%% Paths
 
 images_folder = "data/georgefloyd/images"
+input_file = "data/georgefloyd/blacktuesday.csv"
+output_file = "data/georgefloyd/blacktuesday.imgdata.csv"
 
-df = pd.read_csv("data/georgefloyd/blacktuesday.csv")
-df['filename'] = df['imgUrl'].str.split('/').str[-1].str.split('?').str[0]
+# Set to False for converting small files in memory
+chunked = True
+chunk_size = 1000
 
 #%% Helpers
 
+def get_filenames(df):
+    return df['imgUrl'].str.split('/').str[-1].str.split('?').str[0]
+
 def image_to_data_url(filename, size=(100, 100)):
     if pd.isna(filename):
         return None
 
+    # Encoded thumbnails are cached, see libs/images.py
     image_path = os.path.join(images_folder, filename)
-    if not os.path.isfile(image_path):
-        return None
+    data_url = images.image_to_data_url(image_path, size)
+    if data_url is None and os.path.isfile(image_path):
+        print(f"Error processing image {image_path}")
+    return data_url
 
-    try:
-        img = Image.open(image_path)
-        img = img.resize(size, Image.Resampling.LANCZOS)
-        buffered = BytesIO()
-        img.save(buffered, format="JPEG")
-        img_bytes = buffered.getvalue()
-        base64_str = base64.b64encode(img_bytes).decode("utf-8")
-        data_url = f"data:image/jpeg;base64,{base64_str}"
-        return data_url
-    except Exception as e:
-        print(f"Error processing image {image_path}: {e}")
-        return None
+def report_errors(filepaths, data_urls):
+    """Print existing image files that could not be encoded and return their number."""
+    errors = 0
+    for filepath, data_url in zip(filepaths, data_urls):
+        if data_url is None and filepath and os.path.isfile(filepath):
+            print(f"Error processing image {filepath}")
+            errors += 1
+    return errors
+
+def save_progress(progress_file, chunks, offset):
+    tmp_file = progress_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump({"chunks": chunks, "offset": offset}, f)
+    os.replace(tmp_file, progress_file)
+
+def convert_chunked(input_file, output_file, chunk_size=1000, workers=None, resume=True):
+    """
+    Add data URLs chunk by chunk and append each chunk to the output file.
+
+    The progress file next to the output stores the number of completed chunks
+    and the output size after the last completed chunk. On resume,
+    a partially written chunk is truncated and the conversion continues from there.
+
+    Returns the number of images that could not be encoded.
+    """
+    progress_file = output_file + ".progress"
+
+    done = 0
+    if resume and os.path.isfile(progress_file) and os.path.isfile(output_file):
+        with open(progress_file) as f:
+            progress = json.load(f)
+        done = progress["chunks"]
+        with open(output_file, "r+b") as f:
+            f.truncate(progress["offset"])
+        print(f"Resuming after {done} chunks.")
+    elif os.path.isfile(output_file):
+        os.remove(output_file)
+
+    errors = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunks = pd.read_csv(input_file, chunksize=chunk_size)
+        for chunk_no, chunk in enumerate(tqdm(chunks, desc="Chunks")):
+            if chunk_no < done:
+                continue
+
+            chunk['filename'] = get_filenames(chunk)
+            filepaths = [os.path.join(images_folder, x) if isinstance(x, str) else None for x in chunk['filename']]
+            data_urls = images.images_to_data_urls(filepaths, executor=executor)
+            errors += report_errors(filepaths, data_urls)
+            chunk['imgdata'] = data_urls
+
+            with open(output_file, "a", newline="", encoding="utf-8") as f:
+                chunk.to_csv(f, header=(chunk_no == 0), index=False)
+            save_progress(progress_file, chunk_no + 1, os.path.getsize(output_file))
+
+    os.remove(progress_file)
+    return errors
+
+#%% Convert in memory
+
+# The process pool imports this script again, the guards keep the workers from running it
+if __name__ == "__main__" and not chunked:
+    df = pd.read_csv(input_file)
+    df['filename'] = get_filenames(df)
+    df['imgdata'] = df['filename'].progress_apply(image_to_data_url)
+    df.to_csv(output_file, index=False)
 
-#%% Convert
+#%% Convert in chunks using all cores
 
-df['imgdata'] = df['filename'].progress_apply(image_to_data_url)
\ No newline at end of file
+if __name__ == "__main__" and chunked:
+    errors = convert_chunked(input_file, output_file, chunk_size)
+    print(f"Done. {errors} images could not be encoded.")
@@ -1,14 +1,22 @@
 #%%
 # Inject base64 encoded images as data URLS into a gexf file
 # Those files can be visualised with Gephi Lite.
+#
+# The file is streamed: each node is read, gets its data URL and is written
+# to the output immediately, so memory does not grow with the graph size.
+# Edges, layout and all other elements are copied unchanged.
+#
+# Before streaming, the distinct images referenced by the nodes are encoded
+# once in parallel into the thumbnail cache (see libs/images.py),
+# so duplicates such as reposts of the same meme are not encoded again.
 
 import os
-import base64
+from collections import Counter
 from lxml import etree
-from PIL import Image
-from io import BytesIO
 from tqdm import tqdm
 
+from libs.images import image_to_data_url, cache_images, THUMBNAIL_CACHE
+
 #%% Paths
 
 gexf_input_path = "data/microcefalia/microcefalia.layouted.gexf"
@@ -16,99 +24,157 @@ gexf_output_path = "data/microcefalia/microcefalia.img.layouted.gexf"
 images_folder = "data/microcefalia/images"
 
 #%% Helpers
-def image_to_data_url(image_path, size=(100, 100)):
-    try:
-        img = Image.open(image_path)
-        img = img.resize(size, Image.Resampling.LANCZOS)
-        buffered = BytesIO()
-        img.save(buffered, format="JPEG")
-        img_bytes = buffered.getvalue()
-        base64_str = base64.b64encode(img_bytes).decode("utf-8")
-        data_url = f"data:image/jpeg;base64,{base64_str}"
-        return data_url
-    except Exception as e:
-        print(f"Error processing image {image_path}: {e}")
-        return None
-
-#%% Load gexf file
-parser = etree.XMLParser(remove_blank_text=True)
-tree = etree.parse(gexf_input_path, parser)
-root = tree.getroot()
-
-nsmap = root.nsmap
-gexf_ns = nsmap.get(None)
-ns = {"g": gexf_ns}  # prefix 'g' used for XPath queries
-
-#%% Add imgdata attribute to graph header
-
-attributes_xpath = ".//g:graph/g:attributes[@class='node']"
-attributes_elems = root.xpath(attributes_xpath, namespaces=ns)
-
-if attributes_elems:
-    attributes_node = attributes_elems[0]
-    if not attributes_node.xpath("g:attribute[@id='imgdata']", namespaces=ns):
-        new_attribute = etree.Element(f"{{{gexf_ns}}}attribute")
-        new_attribute.set("id", "imgdata")
-        new_attribute.set("title", "imgdata")
-        new_attribute.set("type", "string")
-        attributes_node.append(new_attribute)
-
-#%% Add images
-
-nodes_xpath = ".//g:graph/g:nodes/g:node"
-attvalues_tag = "g:attvalues"
-attvalue_tag = "g:attvalue"
 
-errors = []
-nodes = root.xpath(nodes_xpath, namespaces=ns)
-for node in tqdm(nodes, desc="Processing nodes"):
-    # find attvalues element
-    attvalues = node.find(attvalues_tag, namespaces=ns)
+# Elements that are opened and closed in the output while their children are streamed
+CONTAINERS = {"gexf", "graph", "nodes", "edges"}
+
+def write_element(xf, element):
+    """Write an element with its children, reusing the namespace declarations of the root."""
+    with xf.element(element.tag, element.attrib):
+        if element.text:
+            xf.write(element.text)
+        for child in element:
+            write_element(xf, child)
+
+def add_node_attribute(attributes, ns):
+    """Declare the imgdata attribute in the node attributes header."""
+    for attribute in attributes.iterfind(f"{ns}attribute"):
+        if attribute.get("id") == "imgdata":
+            return
+
+    new_attribute = etree.SubElement(attributes, f"{ns}attribute")
+    new_attribute.set("id", "imgdata")
+    new_attribute.set("title", "imgdata")
+    new_attribute.set("type", "string")
+
+def add_node_image(node, ns, errors):
+    """Add or replace the imgdata attvalue of a node."""
+    attvalues = node.find(f"{ns}attvalues")
     if attvalues is None:
-        continue
+        return
 
-    # find attvalue with attribute for="img"
-    img_attvalue = None
-    for attvalue in attvalues.findall(attvalue_tag, namespaces=ns):
+    # find attvalues with attribute for="img" and for="imgdata" in one pass
+    img_filename = None
+    existing_imgdata = None
+    for attvalue in attvalues.iterfind(f"{ns}attvalue"):
         if attvalue.get("for") == "img":
-            img_attvalue = attvalue
-            break
-
-    if img_attvalue is None:
-        continue
+            img_filename = attvalue.get("value")
+        elif attvalue.get("for") == "imgdata":
+            existing_imgdata = attvalue
 
-    img_filename = img_attvalue.get("value")
     if not img_filename:
-        continue
+        return
 
     img_path = os.path.join(images_folder, img_filename)
-
     if not os.path.isfile(img_path):
         errors.append(f"Image file not found for node id={node.get('id')}: {img_filename}")
-        continue
+        return
 
     data_url = image_to_data_url(img_path)
     if data_url is None:
-        continue
+        return
 
-    # add or replace attvalue with for="imgdata"
-    existing_imgdata = None
-    for attvalue in attvalues.findall(attvalue_tag, namespaces=ns):
-        if attvalue.get("for") == "imgdata":
-            existing_imgdata = attvalue
-            break
+    if existing_imgdata is None:
+        existing_imgdata = etree.SubElement(attvalues, f"{ns}attvalue")
+        existing_imgdata.set("for", "imgdata")
+    existing_imgdata.set("value", data_url)
 
-    if existing_imgdata is not None:
-        existing_imgdata.set("value", data_url)
-    else:
-        new_attvalue = etree.Element(f"{{{gexf_ns}}}attvalue")
-        new_attvalue.set("for", "imgdata")
-        new_attvalue.set("value", data_url)
-        attvalues.append(new_attvalue)
+def collect_images(input_path):
+    """Count how many nodes reference each image filename."""
+    counts = Counter()
 
-print(f"Done. {len(errors)} errors.")
+    for _, element in etree.iterparse(input_path, events=("end",), huge_tree=True):
+        name = etree.QName(element).localname
 
-#%% Save
+        # Edges are not needed, stop when all nodes are read
+        if name == "nodes":
+            break
+        if name not in ("node", "edge"):
+            continue
+
+        if name == "node":
+            for attvalue in element.iterfind("{*}attvalues/{*}attvalue"):
+                if attvalue.get("for") == "img" and attvalue.get("value"):
+                    counts[attvalue.get("value")] += 1
+                    break
+
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+    return counts
+
+def inject_images(input_path, output_path):
+    """Stream the gexf file and add data URLs to all nodes with an img attribute."""
+    errors = []
+    progress = tqdm(desc="Processing nodes")
+
+    events = etree.iterparse(input_path, events=("start", "end"), remove_blank_text=True, huge_tree=True)
+    with open(output_path, "wb") as f, etree.xmlfile(f, encoding="utf-8") as xf:
+        xf.write_declaration()
+        open_containers = []
+
+        for event, element in events:
+            name = etree.QName(element).localname
+            parent = element.getparent()
+            in_container = parent is not None and etree.QName(parent).localname in CONTAINERS
+
+            if name in CONTAINERS and (parent is None or in_container):
+                if event == "start":
+                    # Only the root declares namespaces, all other elements reuse them
+                    nsmap = element.nsmap if parent is None else None
+                    container = xf.element(element.tag, element.attrib, nsmap=nsmap)
+                    container.__enter__()
+                    open_containers.append(container)
+                    xf.write("\n")
+                else:
+                    open_containers.pop().__exit__(None, None, None)
+                    if open_containers:
+                        xf.write("\n")
+                continue
+
+            if event != "end" or not in_container:
+                continue
+
+            # Namespace prefix for child tags, e.g. {http://gexf.net/1.3}
+            namespace = etree.QName(element).namespace
+            ns = f"{{{namespace}}}" if namespace else ""
+
+            if name == "attributes" and element.get("class") == "node":
+                add_node_attribute(element, ns)
+            elif name == "node":
+                add_node_image(element, ns, errors)
+                progress.update()
+
+            write_element(xf, element)
+            xf.write("\n")
+
+            # Free the written element and its already written siblings
+            element.clear()
+            while element.getprevious() is not None:
+                del parent[0]
+
+    progress.close()
+    return errors
+
+#%% Encode each distinct image once, in parallel
+# Deduplication needs the disk cache (GRAPHIM_THUMBNAIL_CACHE), otherwise images are encoded while streaming.
+# The process pool imports this script again, the guard keeps the workers from running it.
+
+if __name__ == "__main__":
+    if THUMBNAIL_CACHE:
+        counts = collect_images(gexf_input_path)
+        filepaths = [os.path.join(images_folder, x) for x in counts]
+        encoded = cache_images([x for x in filepaths if os.path.isfile(x)])
+
+        total = sum(counts.values())
+        print(f"{total} nodes reference {len(counts)} distinct images, {encoded} encoded.")
+        print(f"{total - len(counts)} encodes saved by deduplication.")
+    else:
+        print("Thumbnail cache disabled, each node image is encoded while streaming.")
 
-tree.write(gexf_output_path, pretty_print=True, encoding="utf-8", xml_declaration=True)
+#%% Add images
 
+if __name__ == "__main__":
+    errors = inject_images(gexf_input_path, gexf_output_path)
+    print(f"Done. {len(errors)} errors.")
@@ -0,0 +1,84 @@
+#
+# Evaluate the text-presence prefilters of libs/ocr.py
+#
+# Full OCR on every image is the reference: an image contains text
+# if EasyOCR recognizes anything. For each prefilter, the script reports
+# precision and recall of the "text present" decision, the throughput
+# and how often the extracted text equals the full OCR result.
+#
+
+#%% Imports
+import os
+import time
+import random
+import numpy as np
+import pandas as pd
+import easyocr
+from PIL import Image
+
+from libs.ocr import read_image, detect_text, has_text_edges
+
+#%% Settings
+
+input_folder = 'data/memesgerman/images/'
+sample_size = 200
+prefilter_size = 640
+
+image_files = [f for f in os.listdir(input_folder) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
+random.seed(0)
+image_files = random.sample(image_files, min(sample_size, len(image_files)))
+
+reader = easyocr.Reader(['de'], gpu=False, verbose=False)
+
+#%% Helpers
+
+def load(filename):
+    with Image.open(os.path.join(input_folder, filename)) as img:
+        return np.asarray(img.convert("RGB"))
+
+def has_text_detect(img):
+    horizontal_list, free_list = detect_text(reader, img, prefilter_size)
+    return bool(horizontal_list or free_list)
+
+#%% Reference: full OCR
+
+images = [load(f) for f in image_files]
+
+start = time.perf_counter()
+reference = [read_image(reader, img) for img in images]
+time_full = time.perf_counter() - start
+has_text = np.array([bool(text.strip()) for text in reference])
+
+#%% Prefilters
+
+rows = [{
+    'method': 'full OCR',
+    'precision': None,
+    'recall': None,
+    'skipped': 0.0,
+    'images per second': len(images) / time_full,
+    'same text': 1.0
+}]
+
+deciders = {'detect': has_text_detect, 'edges': lambda img: has_text_edges(img, prefilter_size)}
+for prefilter, decide in deciders.items():
+    predicted = np.array([decide(img) for img in images])
+
+    start = time.perf_counter()
+    texts = [read_image(reader, img, prefilter, prefilter_size) for img in images]
+    elapsed = time.perf_counter() - start
+
+    true_positives = (predicted & has_text).sum()
+    rows.append({
+        'method': prefilter,
+        'precision': true_positives / max(predicted.sum(), 1),
+        'recall': true_positives / max(has_text.sum(), 1),
+        'skipped': 1 - predicted.mean(),
+        'images per second': len(images) / elapsed,
+        'same text': np.mean([a == b for a, b in zip(texts, reference)])
+    })
+
+#%% Results
+
+print(f"{len(images)} images, {has_text.sum()} with text according to full OCR.")
+print(pd.DataFrame(rows).round(3).to_string(index=False))
@@ -0,0 +1,73 @@
+#
+# Benchmark thumbnail generation on a synthetic JPEG corpus
+#
+# Compares a full decode followed by a LANCZOS resize
+# with libs.images.load_thumbnail(), which decodes JPEGs
+# at reduced resolution (draft) and downscales with a reducing gap.
+#
+
+#%% Imports
+import os
+import time
+import shutil
+import tempfile
+import numpy as np
+from PIL import Image
+
+from libs.images import load_thumbnail
+
+#%% Settings
+
+num_images = 20
+image_size = (4000, 3000)
+thumbnail_size = (100, 100)
+
+#%% Create synthetic photos: smooth gradients with noise, saved as JPEG
+
+corpus_folder = tempfile.mkdtemp(prefix="thumbnails_")
+rng = np.random.default_rng(0)
+
+width, height = image_size
+x = np.linspace(0, 1, width)[None, :, None]
+y = np.linspace(0, 1, height)[:, None, None]
+filepaths = []
+for i in range(num_images):
+    colors = rng.uniform(0, 255, size=(2, 3))
+    pixels = colors[0] * x + colors[1] * y + rng.normal(0, 4, size=(height, width, 3))
+    image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+    filepath = os.path.join(corpus_folder, f"img_{i}.jpg")
+    image.save(filepath, format="JPEG", quality=90)
+    filepaths.append(filepath)
+
+#%% Helpers
+
+def full_decode(filepath):
+    image = Image.open(filepath).convert("RGB")
+    image.thumbnail(thumbnail_size, Image.Resampling.LANCZOS)
+    return image
+
+def benchmark(func):
+    results = []
+    start = time.perf_counter()
+    for filepath in filepaths:
+        results.append(func(filepath))
+    return time.perf_counter() - start, results
+
+#%% Run
+
+time_full, thumbs_full = benchmark(full_decode)
+time_draft, thumbs_draft = benchmark(lambda filepath: load_thumbnail(filepath, thumbnail_size))
+
+diffs = [np.abs(np.asarray(a, dtype=float) - np.asarray(b, dtype=float)).mean()
+         for a, b in zip(thumbs_full, thumbs_draft)]
+
+print(f"{num_images} JPEGs at {width}x{height} to {thumbnail_size[0]}x{thumbnail_size[1]}")
+print(f"Full decode:   {1000 * time_full / num_images:.1f} ms per image")
+print(f"Draft decode:  {1000 * time_draft / num_images:.1f} ms per image")
+print(f"Speedup:       {time_full / time_draft:.1f}x")
+print(f"Mean absolute pixel difference: {np.mean(diffs):.2f} (0-255)")
+
+#%% Clean up
+
+shutil.rmtree(corpus_folder)
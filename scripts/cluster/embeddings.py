@@ -4,78 +4,106 @@
 # The script follows the approch used in [The evolution of political memes: Detecting and characterizing internet memes with multi-modal deep learning](https://www.sciencedirect.com/science/article/pii/S0306457319307988?casa_token=cWOC3lAL0doAAAAA:0E1Kfggg2MeWF9iOj9RBT56bfeP88bddkdMzI6u7LilF9CCh60oKAZ72d-AFdTo4Ia4wHYv1EjEf). 
 # 
 # 1. Feature extraction using google/vit-base-patch16-224
-# 2. Calculate Euclidian distance 
+# 2. Calculate Euclidian distances to the nearest neighbours (blockwise, without the full distance matrix)
 # 3. Construct graph based on radius 
+# 4. Cluster the graph into connected components and Louvain communities
 # 
 # Model information; https://huggingface.co/google/vit-base-patch16-224
 
 #%% Imports
 import os
 import torch
+import pandas as pd
 
 from transformers import AutoImageProcessor, AutoModel
-from PIL import Image
 
 from libs.networks import *
+from libs.embeddings import EmbeddingStore, extract_features
 
 #from libs.settings import *
 data_folder = 'data/memesgerman/'
 imagefolder = data_folder + "images/"
 outputfolder = data_folder + "embeddings/"
 
+#%% Settings
 
-#%% Helpers
+# Larger batches are faster until memory runs out
+batch_size = 32
 
-def load_images(folder_path, processor, model):
-    """Load and preprocess all images in a folder."""
+# Processes decoding images, set to 0 to decode in the main process
+num_workers = 4
 
-    tensors = []
-    images = []
-    filenames = []
-    features = []
-
-    for filename in os.listdir(folder_path):
-        if filename.endswith((".png", ".jpg", ".jpeg")):
-            filenames.append(filename)
-
-            image_path = os.path.join(folder_path, filename)
-            image = Image.open(image_path).convert("RGB")
-            image.thumbnail((100, 100), Image.Resampling.LANCZOS)  # Resize images for visualization
-            images.append(image)
-
-            inputs = processor(images=image, return_tensors="pt")
-            tensor = inputs.to(DEVICE)
-            tensors.append(tensor)
-
-            with torch.no_grad():
-                outputs = model(**tensor)
-                features.append(outputs.last_hidden_state[:, 0, :])  # Class token
-
-    return filenames, images, tensors, features
+# Radius of the graph, None estimates it for the target average number of neighbours per node
+radius = None
+target_degree = 10
 
+# Louvain resolution, higher values result in smaller communities
+resolution = 1.0
 
 #%% Load model
 
-DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
-processor = AutoImageProcessor.from_pretrained("google/vit-base-patch16-224")
-model = AutoModel.from_pretrained("google/vit-base-patch16-224").to(DEVICE)
-
+# DataLoader workers and the process pool of get_nodes() may be spawned and import this script again,
+# the guards keep them from loading the model and running the pipeline themselves
+if __name__ == "__main__":
+    DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+    processor = AutoImageProcessor.from_pretrained("google/vit-base-patch16-224")
+    model = AutoModel.from_pretrained("google/vit-base-patch16-224").to(DEVICE)
 
 #%% Process images
 
-filenames, images, tensors, features = load_images(imagefolder, processor, model)
-
-#%% Calculate a pairwise Euclidean distance matrix
-
-features = torch.cat(features)
-distmatrix = torch.cdist(features, features, p=2)
+# Features of the class token, images are downscaled to 100x100 first as for the visualization.
+# Features are stored in outputfolder/store, only new or changed images are embedded on later runs.
+if __name__ == "__main__":
+    filenames = [f for f in os.listdir(imagefolder) if f.endswith((".png", ".jpg", ".jpeg"))]
+    store = EmbeddingStore(outputfolder + "store/", "google/vit-base-patch16-224", preprocessing="thumbnail-100")
+    embedded = store.update(
+        [os.path.join(imagefolder, f) for f in filenames],
+        lambda filepaths: extract_features(filepaths, processor, model, batch_size=batch_size,
+                                           num_workers=num_workers, size=(100, 100)),
+        ids=filenames
+    )
+    print(f"Embedded {embedded} new or changed images, {len(store)} in the store.")
+
+    # Memory-mapped, unreadable images are skipped
+    filenames, features = store.get(filenames)
+
+#%% Choose the radius from the distances within a sample of images
+# Predicts the graph size in milliseconds, instead of building graphs for several radii
+
+if __name__ == "__main__":
+    if radius is None:
+        radius = estimate_radius(features, degree=target_degree)
+    print(get_radius_statistics(features, [radius * f for f in (0.8, 0.9, 1.0, 1.1, 1.2)]))
+
+#%% Find all pairs within the radius, block by block
+# Avoids the quadratic distance matrix. For very large collections,
+# use method="hnsw" with an upper bound k of neighbours per node.
+
+if __name__ == "__main__":
+    edgelist = get_neighbour_edges(features, filenames, radius=radius, method="exact")
+    print(f"Radius {radius:.2f}: {len(edgelist)} edges, average degree {2 * len(edgelist) / len(filenames):.1f}")
+    edgelist.to_csv(outputfolder + 'edges.csv', index=False)
+
+#%% Cluster the graph on a sparse adjacency matrix
+# Edges are unweighted, because their weights are distances, not similarities
+
+if __name__ == "__main__":
+    ids = pd.Index(filenames)
+    adjacency = get_adjacency(ids.get_indexer(edgelist['source']), ids.get_indexer(edgelist['target']), len(ids))
+    components = get_clusters(adjacency, method="components")
+    communities = get_clusters(adjacency, method="louvain", resolution=resolution)
+    print(f"{components.max() + 1} components, {communities.max() + 1} communities, "
+          f"modularity {get_modularity(adjacency, communities, resolution):.3f}")
 
 #%% Save using helper functions in libs/networks.py
 
-edgelist = get_edges(distmatrix, 20, filenames)
-edgelist.to_csv(outputfolder + 'edges.csv', index=False)
+# Thumbnails are encoded from the files in a process pool, straight into the node table
+if __name__ == "__main__":
+    nodeslist = get_nodes(filenames, filepaths=[os.path.join(imagefolder, f) for f in filenames])
 
-nodeslist = get_nodes(filenames, images)
-nodeslist.to_csv(outputfolder + 'nodes.csv', index=False)
+    # Cluster ids are written as node attributes, e.g. to color the nodes in Gephi
+    nodeslist['component'] = components
+    nodeslist['community'] = communities
+    nodeslist.to_csv(outputfolder + 'nodes.csv', index=False)
 
-create_gexf(edgelist, nodeslist, outputfolder + 'embeddings.gexf')
\ No newline at end of file
+    create_gexf(edgelist, nodeslist, outputfolder + 'embeddings.gexf')
@@ -1,12 +1,19 @@
 #
 # Example for caption generation
 #
+# Images are decoded and preprocessed by DataLoader workers,
+# while the model generates captions for whole batches.
+#
 
 import os
+import time
+import torch
 from tqdm import tqdm
 import pandas as pd
+from torch.utils.data import DataLoader
 from transformers import BlipProcessor, BlipForConditionalGeneration
-from PIL import Image
+
+from libs.datasets import ImageDataset, collate_images
 
 data_folder = 'data/memesgerman/'
 
@@ -15,28 +22,49 @@ input_folder = data_folder + 'images/'
 output_file = data_folder + 'text/blipcaptions.csv'
 
 # Get all image files in the input folder
-image_files = [f for f in os.listdir(input_folder) if f.endswith(('png', 'jpg', 'jpeg'))]
+image_files = [f for f in os.listdir(input_folder) if f.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif'))]
+
+#%% Settings
+
+# Larger batches are faster until memory runs out
+batch_size = 16
+max_new_tokens = 30
+
+# Processes decoding images, set to 0 to decode in the main process
+num_workers = 4
 
 #%% Load the processor and model
-processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
-model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base")
+
+# DataLoader workers may be spawned and import this script again,
+# the guards keep them from loading the model and generating captions themselves
+if __name__ == "__main__":
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
+    model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base").to(device)
+    model.eval()
 
 #%% Generate captions
 
-# Process each image in the directory
-captions = {}
-for filename in tqdm(image_files):
-    if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif')):
-        file_path = os.path.join(input_folder, filename)
-        img = Image.open(file_path).convert('RGB')
+if __name__ == "__main__":
+    dataset = ImageDataset([os.path.join(input_folder, f) for f in image_files], processor.image_processor)
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, collate_fn=collate_images)
 
-        inputs = processor(images=img, return_tensors="pt")
-        out = model.generate(**inputs)
+    captions = {}
+    start = time.perf_counter()
+    for indexes, pixel_values in tqdm(loader):
+        if pixel_values is None:
+            continue
 
-        caption = processor.decode(out[0], skip_special_tokens=True)
-        captions[filename] = caption
+        with torch.no_grad():
+            out = model.generate(pixel_values=pixel_values.to(device), max_new_tokens=max_new_tokens)
 
-#%% Save to CSV
-results = pd.DataFrame(list(captions.items()), columns=['filename', 'text'])
-results.to_csv(output_file, index=False,sep=";")
+        for index, caption in zip(indexes, processor.batch_decode(out, skip_special_tokens=True)):
+            captions[image_files[index]] = caption
 
+    elapsed = time.perf_counter() - start
+    print(f"{len(captions)} images in {elapsed:.1f} s, {len(captions) / elapsed:.2f} images per second.")
+
+#%% Save to CSV
+if __name__ == "__main__":
+    results = pd.DataFrame(list(captions.items()), columns=['filename', 'text'])
+    results.to_csv(output_file, index=False,sep=";")
@@ -1,36 +1,80 @@
 # Image prompts
+#
+# Sends a prompt with each image of a folder (or listed in a CSV file)
+# to the OpenAI Responses API. Requests run concurrently within rate limits,
+# results are appended to a JSON lines file. Rerun the cell to continue an interrupted run.
+#
+# For testing without costs, start the stub server (scripts/extract/llm_stub.py)
+# and set base_url = "http://localhost:8000/v1".
+#
+# In Jupyter or an interactive window, where an event loop is already running,
+# llm.prompt_images() runs the requests in a worker thread and blocks the kernel.
+# Use `counts = await llm.prompt_images_async(...)` with the same arguments to keep it responsive.
 
 #%%
-import base64
-from openai import OpenAI
+import os
+import pandas as pd
+
+from libs import llm
+from libs.responsecache import ResponseCache
 
 # Set the API key in libs/settings.py
 from libs import settings
-client = OpenAI(api_key = settings.openai_apikey)
 
+data_folder = 'data/memesgerman/'
 
-#%%
-image_path = "data/memesgerman/images/msg10.png"
-with open(image_path, "rb") as image_file:
-    b64_image = base64.b64encode(image_file.read()).decode("utf-8")
+#%% Settings
+input_folder = data_folder + 'images/'
+output_file = data_folder + 'text/llm.jsonl'
 
-#%%
-#prompt = "What is in this image?"
+# Optional: CSV file with a column of image filenames in the input folder
+input_csv = None
+filename_column = 'filename'
+
+model = "gpt-4o-mini"
+base_url = None
+
+# Stay below the limits of your API tier
+concurrency = 8
+requests_per_minute = 500
+tokens_per_minute = 200000
 
+# Upload budget per image: images are downscaled and recompressed to fit (None for no limit).
+# Upload size dominates the latency of large batches, image tokens the costs.
+max_bytes = 500000
+max_tokens = None
+
+# Answers are cached by image content, prompt and model in data/cache/responses.sqlite.
+# Inspect or expire the cache with: python -m libs.responsecache stats|export, or expire --days 30
+cache = ResponseCache()
+
+#prompt = "What is in this image?"
 prompt = "Who or what is in the image, what is the context of the image, how is it discussed on the web?"
-response = client.responses.create(
-    model="gpt-4o-mini",
-    input=[
-        {
-            "role": "user",
-            "content": [
-                {"type": "input_text", "text": prompt},
-                {"type": "input_image", "image_url": f"data:image/png;base64,{b64_image}"},
-            ],
-        }
-    ],
+
+#%% Collect images
+if input_csv:
+    image_files = pd.read_csv(input_csv)[filename_column].dropna().tolist()
+else:
+    image_files = [f for f in os.listdir(input_folder) if f.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.webp'))]
+
+#%% Prompt
+counts = llm.prompt_images(
+    [os.path.join(input_folder, f) for f in image_files],
+    prompt,
+    output_file,
+    model=model,
+    ids=image_files,
+    api_key=settings.openai_apikey,
+    base_url=base_url,
+    concurrency=concurrency,
+    requests_per_minute=requests_per_minute,
+    tokens_per_minute=tokens_per_minute,
+    max_bytes=max_bytes,
+    max_tokens=max_tokens,
+    cache=cache
 )
+print(counts)
 
 #%%
-print(response.output_text)
-
+results = pd.read_json(output_file, lines=True)
+print(results.head())
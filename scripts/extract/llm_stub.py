@@ -0,0 +1,90 @@
+#
+# Local stub of the OpenAI Responses endpoint for testing libs/llm.py
+#
+# Start the server:
+#   python scripts/extract/llm_stub.py --port 8000 --fail-rate 0.2
+#
+# Then, use base_url="http://localhost:8000/v1" and any api_key.
+# A share of the requests fails with 429 or 500 to exercise the retries.
+#
+
+import json
+import time
+import random
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class ResponsesHandler(BaseHTTPRequestHandler):
+    fail_rate = 0.0
+    latency = 0.2
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/v1/responses":
+            self.send_json(404, {"error": {"message": "Not found", "type": "invalid_request_error"}})
+            return
+
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        time.sleep(self.latency)
+
+        if random.random() < self.fail_rate:
+            if random.random() < 0.5:
+                self.send_json(429, {"error": {"message": "Rate limit reached", "type": "rate_limit_error"}},
+                               {"Retry-After": "0.5"})
+            else:
+                self.send_json(500, {"error": {"message": "Server error", "type": "server_error"}})
+            return
+
+        # Describe the request instead of the image
+        content = body["input"][0]["content"]
+        prompt = next(part["text"] for part in content if part["type"] == "input_text")
+        image_bytes = sum(len(part["image_url"]) for part in content if part["type"] == "input_image")
+        text = f"Stub answer to '{prompt[:40]}' for an image of {image_bytes} bytes."
+
+        self.send_json(200, {
+            "id": f"resp_{random.getrandbits(48):x}",
+            "object": "response",
+            "created_at": int(time.time()),
+            "model": body.get("model"),
+            "status": "completed",
+            "output": [{
+                "type": "message",
+                "id": f"msg_{random.getrandbits(48):x}",
+                "status": "completed",
+                "role": "assistant",
+                "content": [{"type": "output_text", "text": text, "annotations": []}]
+            }],
+            "usage": {
+                "input_tokens": image_bytes // 1000 + len(prompt) // 4,
+                "output_tokens": len(text) // 4,
+                "total_tokens": image_bytes // 1000 + len(prompt) // 4 + len(text) // 4
+            }
+        })
+
+    def send_json(self, status, data, headers=None):
+        payload = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stub of the OpenAI Responses endpoint")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Share of requests failing with 429 or 500")
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds per request")
+    args = parser.parse_args()
+
+    ResponsesHandler.fail_rate = args.fail_rate
+    ResponsesHandler.latency = args.latency
+
+    server = ThreadingHTTPServer(("localhost", args.port), ResponsesHandler)
+    print(f"Listening on http://localhost:{args.port}/v1")
+    server.serve_forever()
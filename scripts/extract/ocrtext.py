@@ -2,11 +2,11 @@
 # Text extraction using OCR
 #
 
-import easyocr
 import os
-from PIL import Image
+import time
 import pandas as pd
-from tqdm import tqdm
+
+from libs.ocr import read_text
 
 #from libs.settings import *
 #data_folder = datapath + 'data/memesgerman/'
@@ -17,22 +17,31 @@ input_folder = data_folder + 'images/'
 output_file = data_folder + 'text/easyocr.csv'
 
 # Get all image files in the input folder
-image_files = [f for f in os.listdir(input_folder) if f.endswith(('png', 'jpg', 'jpeg'))]
+image_files = [f for f in os.listdir(input_folder) if f.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif'))]
+
+#%% Settings
+
+# Number of processes, each loads its own EasyOCR reader.
+# With 1, the reader runs in this process and uses the GPU if available.
+workers = 4
+
+# Skip full OCR on images without text: None, "detect" or "edges", see libs/ocr.py.
+# Check precision and recall on your data with scripts/benchmark/ocr_prefilter.py first.
+prefilter = None
 
 #%% OCR
 
-reader = easyocr.Reader(['de'])
+# Workers are spawned and import this script again, the guard keeps them from starting OCR themselves
+if __name__ == "__main__":
+    start = time.perf_counter()
+    texts = read_text([os.path.join(input_folder, f) for f in image_files], ['de'], workers=workers, prefilter=prefilter)
+    elapsed = time.perf_counter() - start
+    print(f"{len(image_files)} images in {elapsed:.1f} s, {len(image_files) / elapsed:.2f} images per second.")
 
-ocr_results = {}
-for filename in tqdm(image_files):
-    if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif')):
-        file_path = os.path.join(input_folder, filename)
-        img = Image.open(file_path)
-        result = reader.readtext(img)
-        extracted_text = ' '.join([text[1] for text in result])
-        ocr_results[filename] = extracted_text
+    # Results are in the order of image_files
+    ocr_results = {filename: text for filename, text in zip(image_files, texts) if text is not None}
 
 #%% Save to CSV
-results = pd.DataFrame(list(ocr_results.items()), columns=['filename', 'text'])
-results.to_csv(output_file, index=False,sep=";")
-
+if __name__ == "__main__":
+    results = pd.DataFrame(list(ocr_results.items()), columns=['filename', 'text'])
+    results.to_csv(output_file, index=False,sep=";")
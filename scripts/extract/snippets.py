@@ -19,7 +19,7 @@ import torch
 import cv2
 import numpy as np
 
-from scipy.sparse.csgraph import connected_components
+from libs.masks import PackedMasks, MaskCache, mergeMasks, extractSegment, tile_boxes, stitch_masks
 
 #from libs.settings import *
 # data_folder = datapath + 'data/memesgerman/'
@@ -32,6 +32,25 @@ output_folder = data_folder + 'snippets/'
 # Get all image files in the input folder
 image_files = [f for f in os.listdir(input_folder) if f.endswith(('png', 'jpg', 'jpeg'))]
 
+#%% Settings
+
+# FastSAM parameters, part of the mask cache key
+model_file = 'weights/FastSAM.pt'
+model_params = dict(retina_masks=True, imgsz=1024, conf=0.4, iou=0.9)
+
+# Optional tiled mode for high resolution scans: images larger than the tile size
+# are segmented in overlapping tiles, the masks are stitched across the tile borders.
+# Model memory then depends on the tile size instead of the image size,
+# and small components are segmented at a higher resolution. None disables tiling.
+tile_size = None
+tile_overlap = 128
+
+# Raw masks are cached per image (see libs/masks.py), so changing the merge
+# and blur settings reruns only merging and cropping, without FastSAM
+mask_cache = MaskCache(data_folder + 'cache/masks/')
+merge_threshold = 0.6
+blur_kernel_size = 0
+
 #%%
 
 # Load model weights
@@ -60,149 +79,101 @@ torch.serialization.add_safe_globals([getattr])
 torch.serialization.add_safe_globals([ultralytics.nn.modules.head.Detect])
 torch.serialization.add_safe_globals([ultralytics.yolo.utils.IterableSimpleNamespace])
 
-model = FastSAM('weights/FastSAM.pt', verbose=False)
-
-#%% Helpers
-
-def bbox(mask):
-    x, y, w, h = cv2.boundingRect(mask)
-    return (x, y, x + w, y + h)
-
-def box_contains_ratio(box_big, box_small, min_ratio=0.8):
-    # Check area overlap ratio of bounding boxes as rough filter
-    x1_min, y1_min, x1_max, y1_max = box_big
-    x2_min, y2_min, x2_max, y2_max = box_small
-
-    xi_min = max(x1_min, x2_min)
-    yi_min = max(y1_min, y2_min)
-    xi_max = min(x1_max, x2_max)
-    yi_max = min(y1_max, y2_max)
-
-    if xi_min >= xi_max or yi_min >= yi_max:
-        return False
-
-    inter_area = (xi_max - xi_min) * (yi_max - yi_min)
-    small_area = (x2_max - x2_min) * (y2_max - y2_min)
-    return (inter_area / small_area) >= min_ratio
-
-def mergeMasks(masks, threshold = 0.9):
-    # Convert list of masks to numpy array if needed
-    if isinstance(masks, list):
-        masks = np.stack(masks, axis=0)
-
-    masks_bin = (masks > 0.5).astype(np.uint8)
-
-    boxes = [bbox(m) for m in masks_bin]
-
-    # Build adjacency matrix for "mostly contained" relation
-    N = masks_bin.shape[0]
-    adjacency = np.zeros((N, N), dtype=bool)
-
-    for i in range(N):
-        area_i = masks_bin[i].sum()
-        if area_i == 0:
-            continue
-        box_i = boxes[i]
-        for j in range(N):
-            if i == j:
-                continue
-
-            box_j = boxes[j]
-            # Quick bbox filter: is bbox i mostly inside bbox j? Skip otherwise
-            if not box_contains_ratio(box_j, box_i, min_ratio=0.8):
-                continue
-
-            # Compute pixel overlap and ratio
-            intersection = (masks_bin[i] & masks_bin[j]).sum()
-            ratio = intersection / area_i
-
-            if ratio >= threshold:
-                adjacency[i, j] = True
-
-    # Symmetrize adjacency for undirected connected groups
-    undirected_adj = adjacency | adjacency.T
-
-    # Find connected components
-    n_components, labels = connected_components(csgraph=undirected_adj, directed=False, return_labels=True)
-
-    # Merge masks in each group
-    merged_masks = []
-    for comp_id in range(n_components):
-        indices = np.where(labels == comp_id)[0]
-        merged = np.clip(masks_bin[indices].sum(axis=0), 0, 1).astype(np.uint8)
-        merged_masks.append(merged)
-
-    return merged_masks
-
-def createTransparentSegment(image_rgb, mask, blur_kernel_size=0, blur_sigma=0):
-    """
-    Create RGBA image with smooth alpha channel from mask.
-    :param image_rgb: (H, W, 3) RGB uint8 image
-    :param mask: (H, W) binary mask uint8 (0 or 255)
-    :param blur_kernel_size: kernel size for Gaussian blur (odd, e.g., 15)
-    :param blur_sigma: Gaussian blur sigma; 0 = auto
-    :return: (H, W, 4) RGBA image with fuzzy alpha
-   """
-    mask = (mask > 0).astype(np.uint8) * 255
-
-    # Convert RGB to BGRA
-    bgra = cv2.cvtColor(image_rgb, cv2.COLOR_RGB2BGRA)
-
-    # Blur mask for fuzzy edges
-    if blur_kernel_size > 0:
-        mask = cv2.GaussianBlur(mask, (blur_kernel_size, blur_kernel_size), blur_sigma)
-        mask = np.clip(mask, 0, 255).astype(np.uint8)
-
-    # Set alpha channel from mask
-    bgra[:, :, 3] = mask
-
-    rgba = cv2.cvtColor(bgra, cv2.COLOR_BGRA2RGBA)
-    return rgba
-
-def cropTransparentSegment(image_rgba):
-    """
-    Crop transparent RGBA image to bounding box of non-transparent pixels.
-    :param bgra: (H, W, 4) BGRA image with alpha channel
-    :return: cropped BGRA image
-    """
-
-    bgra = cv2.cvtColor(image_rgba, cv2.COLOR_RGB2BGRA)
-    alpha = bgra[:, :, 3]
-
-    coords = cv2.findNonZero(alpha)
-    if coords is None:
-        # No non-transparent pixels – return empty image or original
-        return bgra
-
-    x, y, w, h = cv2.boundingRect(coords)
-    cropped = bgra[y:y+h, x:x+w]
-    cropped = cv2.cvtColor(cropped, cv2.COLOR_BGRA2RGBA)
-    return cropped
-
-
+# The model is loaded on first use, not at all if all masks are cached
+model = None
+
+def segment_image(image):
+    """Run FastSAM on a BGR image, in tiles if it is larger than tile_size, and pack the masks."""
+    global model
+    if model is None:
+        model = FastSAM(model_file, verbose=False)
+
+    height, width = image.shape[:2]
+    if tile_size is None or max(height, width) <= tile_size:
+        everything = model(image, device=device, **model_params)
+        if everything[0].masks is None:
+            return PackedMasks(np.zeros((0, height, (width + 7) // 8), dtype=np.uint8), (height, width))
+        return PackedMasks.from_dense(everything[0].masks.data)
+
+    tiles = []
+    for box in tile_boxes(height, width, tile_size, tile_overlap):
+        x_min, y_min, x_max, y_max = box
+        everything = model(image[y_min:y_max, x_min:x_max], device=device, **model_params)
+        if everything[0].masks is not None:
+            tiles.append((box, PackedMasks.from_dense(everything[0].masks.data)))
+    return stitch_masks(tiles, (height, width))
 
 #%% Process images
 
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
+# PNG encoding and writing runs in background threads (OpenCV releases the GIL),
+# overlapping with the segmentation of the next image
+write_workers = 4
+max_pending = 256
+
+def write_segment(filename, segment):
+    start = time.perf_counter()
+    cv2.imwrite(filename, segment)
+    return time.perf_counter() - start
+
 device = "cuda" if torch.cuda.is_available() else "cpu"
-for image_file in tqdm(image_files):
-    image_path = os.path.join(input_folder, image_file)
+timings = defaultdict(float)
+pending = []
+with ThreadPoolExecutor(max_workers=write_workers) as writer:
+    for image_file in tqdm(image_files):
+        image_path = os.path.join(input_folder, image_file)
+
+        # Decoded once, for the inference and the segments
+        start = time.perf_counter()
+        image = cv2.imread(image_path)
+        timings['read'] += time.perf_counter() - start
+        if image is None:
+            print(f"Could not read image {image_path}")
+            continue
 
-    everything = model(image_path, device=device, retina_masks=True, imgsz=1024, conf=0.4, iou=0.9)
-    masks = everything[0].masks.data.cpu().numpy()  # (num_masks, H, W)
-    masks = mergeMasks(masks, 0.6)
+        start = time.perf_counter()
+        cache_params = {'model': model_file, **model_params, 'tile_size': tile_size, 'tile_overlap': tile_overlap}
+        masks = mask_cache.get(image_path, cache_params)
+        timings['cache'] += time.perf_counter() - start
 
-    image = cv2.imread(image_path)
-    image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        # Inference, masks packed to one bit per pixel
+        if masks is None:
+            start = time.perf_counter()
+            masks = segment_image(image)
+            mask_cache.put(image_path, cache_params, masks)
+            timings['inference'] += time.perf_counter() - start
 
-    for i, mask in enumerate(masks):
-        segment = createTransparentSegment(image_rgb, mask)
-        segment = cropTransparentSegment(segment)
+        start = time.perf_counter()
+        masks = mergeMasks(masks, merge_threshold)
+        timings['merge'] += time.perf_counter() - start
 
+        # Crop each mask before building the BGRA segment
+        start = time.perf_counter()
         segment_folder = os.path.join(output_folder, image_file)
         os.makedirs(segment_folder, exist_ok=True)
-        filename = os.path.join(segment_folder, f'segment_{i}.png')
-        cv2.imwrite(filename, cv2.cvtColor(segment, cv2.COLOR_RGBA2BGRA))
-
-    #break
+        for i, mask in enumerate(masks):
+            segment = extractSegment(image, mask, blur_kernel_size)
+            filename = os.path.join(segment_folder, f'segment_{i}.png')
+            pending.append(writer.submit(write_segment, filename, segment))
+        timings['segments'] += time.perf_counter() - start
+
+        # Limit the segments waiting in memory
+        start = time.perf_counter()
+        while len(pending) > max_pending:
+            timings['write'] += pending.pop(0).result()
+        timings['wait'] += time.perf_counter() - start
+
+        #break
+
+    start = time.perf_counter()
+    for future in pending:
+        timings['write'] += future.result()
+    timings['wait'] += time.perf_counter() - start
+
+# Writing happens in the background, only the waiting time adds to the runtime
+for stage, seconds in timings.items():
+    print(f"{stage}: {seconds:.1f} s, {seconds / max(1, len(image_files)):.3f} s per image")
@@ -23,14 +23,21 @@ print("Configuration loaded.")
 # -----------------------------------------------------------
 
 import os
+import numpy as np
 from PIL import Image
 import chromadb
 from chromadb.utils import embedding_functions
 from chromadb.utils.data_loaders import ImageLoader
 
+from libs.embeddings import EmbeddingStore
+
 # Initialize embedding function (OpenCLIP supports text + images)
 embedding_func = embedding_functions.OpenCLIPEmbeddingFunction()
 
+# Image embeddings are kept in an embedding store (see libs/embeddings.py),
+# only new or changed images are embedded when indexing a folder again
+store = EmbeddingStore("./chroma_db/embeddings/", "open-clip-ViT-H-14-laion2b_s32b_b79k", preprocessing="openclip-v1")
+
 # Initialize persistent ChromaDB client
 client = chromadb.PersistentClient(path="./chroma_db")
 
@@ -56,6 +63,30 @@ def is_image_file(filename):
     extensions = {'.jpg', '.jpeg', '.png', '.bmp', '.gif'}
     return any(filename.lower().endswith(ext) for ext in extensions)
 
+def embed_files(filepaths, batch_size=16):
+    """Embed image files in batches with the OpenCLIP embedding function."""
+    features = np.zeros((len(filepaths), 0), dtype=np.float32)
+    found = np.zeros(len(filepaths), dtype=bool)
+
+    for start in range(0, len(filepaths), batch_size):
+        images, indexes = [], []
+        for index in range(start, min(start + batch_size, len(filepaths))):
+            try:
+                with Image.open(filepaths[index]) as img:
+                    images.append(np.array(img.convert("RGB")))
+                indexes.append(index)
+            except Exception as e:
+                print(f"Failed to embed {filepaths[index]}: {e}")
+
+        if images:
+            batch = np.array(embedding_func(images), dtype=np.float32)
+            if features.shape[1] == 0:
+                features = np.zeros((len(filepaths), batch.shape[1]), dtype=np.float32)
+            features[indexes] = batch
+            found[indexes] = True
+
+    return features, found
+
 def add_images_from_folder(folder_path):
     """Add all images in folder to ChromaDB collection using URIs."""
     if not os.path.isdir(folder_path):
@@ -84,12 +115,19 @@ def add_images_from_folder(folder_path):
             print(f"Failed to process {img_file}: {e}")
 
     if uris:
-        collection.add(
+        embedded = store.update(uris, embed_files, ids=ids)
+        print(f"Embedded {embedded} new or changed images.")
+
+        # Keep the images with embeddings
+        metadata_by_id = dict(zip(ids, metadatas))
+        ids, features = store.get(ids)
+        collection.upsert(
             ids=ids,
-            uris=uris,        # Use URIs for multimodal indexing
-            metadatas=metadatas
+            uris=[metadata_by_id[i]["path"] for i in ids],        # Use URIs for multimodal indexing
+            metadatas=[metadata_by_id[i] for i in ids],
+            embeddings=features.tolist()
         )
-        print(f"Added {len(uris)} images to collection.")
+        print(f"Added {len(ids)} images to collection.")
 
 # Run upload
 if UPLOAD_FOLDER:
@@ -22,6 +22,7 @@ from transformers import CLIPProcessor, CLIPModel
 import importlib
 from libs import images
 importlib.reload(images)
+from libs.embeddings import EmbeddingStore, extract_features
 
 import torch
 import numpy as np
@@ -77,6 +78,11 @@ model.eval()
 
 embedding_func = CustomCLIPEmbeddingFunction(model, processor, device=device)
 
+def clip_image_features(model, pixel_values):
+    """Normalized image features, as in CustomCLIPEmbeddingFunction."""
+    feats = model.get_image_features(pixel_values=pixel_values)
+    return feats / feats.norm(dim=-1, keepdim=True)
+
 #%%
 
 # Initialize persistent ChromaDB client
@@ -99,27 +105,40 @@ collection = client.create_collection(
 
 #%% Add to chroma
 
-# You just need to add the absolute image paths as uris.
-# Then. the ImageLoader and the embedding function produce the embeddings
+# Image embeddings are kept in an embedding store (see libs/embeddings.py),
+# only new or changed images are embedded on later runs.
+# After fine-tuning the model again, increase the preprocessing version to start over.
 image_files = [f for f in os.listdir(imagefolder) if f.endswith(".jpg")]
+store = EmbeddingStore(datafolder + "embeddings/clip-di-finetuned/", model_path, preprocessing="clip-v1")
+store.update(
+    [os.path.join(imagefolder, x) for x in image_files],
+    lambda filepaths: extract_features(filepaths, processor, model, batch_size=16, device=device,
+                                       forward=clip_image_features),
+    ids=image_files
+)
+image_files, features = store.get(image_files)
+
 chroma_ids = ["file:" + x for x in image_files]
 chroma_uris = [os.path.join(imagefolder, x) for x in image_files]
 
 collection.add(
     ids = chroma_ids,
-    documents= chroma_uris
+    documents= chroma_uris,
+    embeddings = features.tolist()
 )
 
 #%% Query chroma
 
+# Multiple queries are written to one report
+queries = ["Glocke"]
 results = collection.query(
-    query_texts= "Glocke",
+    query_texts= queries,
     n_results=10,
     include=["distances"]
 )
 
 # After saving, open answer.html in the browser to see the results
-images.chromaResults2Html(results, imagefolder, datafolder + "answer_tuned.html")
+images.chromaResults2Html(results, imagefolder, datafolder + "answer_tuned.html", queries=queries)
 
 
 
@@ -57,13 +57,15 @@ collection.add(
 
 #%% Query chroma
 
+# Multiple queries are written to one report
+queries = ["Frau"]
 results = collection.query(
-    query_texts= "Frau",
+    query_texts= queries,
     n_results=10,
     include=["distances"]
 )
 
 # After saving, open html file in the browser to see the results
-images.chromaResults2Html(results, imagefolder, datafolder + "answer_untuned.html")
+images.chromaResults2Html(results, imagefolder, datafolder + "answer_untuned.html", queries=queries)
 
 
@@ -1,15 +1,16 @@
-import base64
 import json
+import base64
 import requests
 import os
-import io
 import csv
 from pathlib import Path
-from PIL import Image
 from google.oauth2 import service_account
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 
+from libs import images
+from libs.responsecache import ResponseCache
+
 
 #%% lib
 
@@ -26,7 +27,7 @@ def authenticate(service_accout_path):
 
 
 
-def vision_loop(image_path,  token=None, api_key=None, service_account_key_path=None, limit=5):
+def vision_loop(image_path,  token=None, api_key=None, service_account_key_path=None, limit=5, cache=None):
     print(service_account_key_path)
     # Authenticate and set the URL and headers
     if api_key:
@@ -60,7 +61,7 @@ def vision_loop(image_path,  token=None, api_key=None, service_account_key_path=
             break
         if image.is_file():
             full_name = os.path.join(image_path, image.name)
-            vision_result = detect_web_info(full_name, url, headers)
+            vision_result = detect_web_info(full_name, url, headers, cache)
             # vision_result.save(os.path.join(str(Path(image_path).parent), "small", image.name))
             if "responses" not in vision_result or not vision_result["responses"]:
                 print("Error with image " + image.name)
@@ -76,11 +77,25 @@ def vision_loop(image_path,  token=None, api_key=None, service_account_key_path=
         #                        os.path.splitext(image.name)[0] + '.b64'), "w") as f:
         #     f.write(vision_result)
 
-def detect_web_info(image_file, url, headers):
-    max_size = 800
-    # Read, resize, and encode the image
-    with Image.open(image_file, "r") as image:
-        encoded_image = resize_and_encode_image(image, max_size)
+def detect_web_info(image_file, url, headers, cache=None, max_size=800, max_bytes=200000):
+    features = [{"type": "WEB_DETECTION", "maxResults": 10}]
+
+    # Reuse the response for an identical image and request (see libs/responsecache.py)
+    if cache is not None:
+        image_hash = images.file_hash(image_file)
+        params = {"features": features, "max_size": max_size, "max_bytes": max_bytes}
+        result = cache.get(image_hash, "", "cloud-vision", params)
+        if result is not None:
+            return result
+
+    # Pick resolution, format and quality to fit the upload budget (see libs/images.py)
+    payload = images.optimize_payload(image_file, max_bytes=max_bytes, max_size=max_size)
+    if payload is None:
+        print(f"Could not read image {image_file}")
+        return {}
+    encoded_image = base64.b64encode(payload['data']).decode("utf-8")
+    print(f"Uploading {payload['bytes']} bytes ({payload['width']}x{payload['height']} {payload['format']}), "
+          f"saved {payload['saved_bytes']} bytes")
 
     # Construct the request body for WEB_DETECTION
     request_body = {
@@ -89,12 +104,7 @@ def detect_web_info(image_file, url, headers):
                 "image": {
                     "content": encoded_image,
                 },
-                "features": [
-                    {
-                        "type": "WEB_DETECTION",
-                        "maxResults": 10,  # Optional: limit the number of results
-                    }
-                ],
+                "features": features,
             }
         ]
     }
@@ -104,22 +114,11 @@ def detect_web_info(image_file, url, headers):
     response.raise_for_status()
 
     result = response.json()
-    return result
 
-def resize_and_encode_image(image, max_size):
-
-    # resize image
-    img_width, img_height = image.size
-    scale = min(max_size / img_width, max_size / img_height)
-    resized_image = image.resize((int(img_width * scale), int(img_height * scale)), Image.LANCZOS)
-
-    # encode image
-    buffered = io.BytesIO()
-    resized_image.save(buffered, format="JPEG")
-    img_bytes = buffered.getvalue()
-    encoded_image = base64.b64encode(img_bytes).decode("utf-8")
-
-    return encoded_image
+    # Errors per image, e.g. quota or a bad image, come with status 200 and are not cached
+    if cache is not None and not any("error" in entry for entry in result.get("responses", [])):
+        cache.put(image_hash, "", "cloud-vision", result, params)
+    return result
 
 def add_base64encoding_to_csv(input_csvfile, column_with_image_filenames, path_to_image_folder, output_csvfile):
 
@@ -140,11 +139,8 @@ def add_base64encoding_to_csv(input_csvfile, column_with_image_filenames, path_t
         row["image_id_label"] = " "
         if filename:
             full_path = os.path.join(path_to_image_folder, filename)
-            if os.path.isfile(full_path):
-                with Image.open(full_path, "r") as image_file:
-                    row["image_base64"] = "data:image/png;base64," + resize_and_encode_image(image_file, max_size)
-            else:
-                row["image_base64"] = ""
+            data_url = images.image_to_data_url(full_path, (max_size, max_size), fit="contain")
+            row["image_base64"] = data_url or ""
         else:
             row["image_base64"] = ""
 
@@ -191,5 +187,5 @@ add_base64encoding_to_csv("./data/export_lueneburg_epigraf_no_concat.csv",
 #%%
 token = None
 service_account_key_path = "./secrets/service_account_key.json"
-vision_loop("./data/di-100/images-rest", limit = 1000, token=token)
+vision_loop("./data/di-100/images-rest", limit = 1000, token=token, cache=ResponseCache())
 